@@ -3,7 +3,10 @@ Cimas iGo Vision AI — FastAPI Backend
 =====================================
 
   POST /analyze   — Analyse a meal image with Gemini Vision
+  GET  /analysis/{sha256} — Stored result for an image hash (HEAD supported)
+  POST /uploads   — Resumable upload: create session, PATCH chunks, finalize
   GET  /health    — Health check / readiness probe
+  GET  /metrics   — Runtime counters (image memory budget, prompt cache, ...)
   GET  /          — Root info
 
 Run locally:
@@ -12,7 +15,7 @@ Run locally:
 
 from __future__ import annotations
 
-import logging
+import asyncio
 import os
 import time
 from contextlib import asynccontextmanager
@@ -20,13 +23,43 @@ from typing import Any, Dict
 
 import structlog
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, HTTPException, Request, UploadFile, status
+from fastapi import FastAPI, File, Header, HTTPException, Request, Response, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
-from models import AnalyzeResponse, ErrorDetail, HealthResponse, NutritionAnalysis
-from services.gemini_service import GeminiNutritionService
-from utils.image import process_upload
+from models import (
+    AnalyzeResponse,
+    ErrorDetail,
+    HealthResponse,
+    NutritionAnalysis,
+    UploadCreateRequest,
+    UploadSessionResponse,
+)
+from services.backend_pool import BackendPool
+from services.gemini_service import (
+    REQUEST_CONFIG_DIGEST,
+    GeminiNutritionService,
+    build_gemini_pool,
+    parse_key_specs,
+)
+from services.prompt_cache import PromptCache, PromptCacheStats, keep_prompt_caches_warm
+from services.result_store import ResultStore, normalise_hash, sha256_hex
+from services.upload_sessions import (
+    UploadOffsetMismatch,
+    UploadSession,
+    UploadSessionManager,
+    UploadSessionNotFound,
+    UploadStorageFull,
+)
+from services.vision_backend import RecordingBackend, ReplayBackend, VisionBackend
+from utils.image import (
+    ImageQualityError,
+    QualityThresholds,
+    estimate_processing_bytes,
+    process_upload,
+)
+from utils.logging_setup import configure_logging, parse_sample_rates
+from utils.memory_budget import ImageMemoryBudget, MemoryBudgetExceeded
 
 # ─── Load environment ─────────────────────────────────────────────────────────
 
@@ -34,18 +67,18 @@ load_dotenv()
 
 # ─── Logging setup ────────────────────────────────────────────────────────────
 
-structlog.configure(
-    processors=[
-        structlog.processors.TimeStamper(fmt="iso"),
-        structlog.stdlib.add_log_level,
-        structlog.stdlib.PositionalArgumentsFormatter(),
-        structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
-        structlog.dev.ConsoleRenderer(),
-    ],
-    wrapper_class=structlog.make_filtering_bound_logger(logging.INFO),
-    context_class=dict,
-    logger_factory=structlog.PrintLoggerFactory(),
+# Production defaults to JSON via a background writer; dev keeps the console renderer
+LOG_FORMAT: str = os.getenv(
+    "LOG_FORMAT", "console" if os.getenv("ENV", "development") == "development" else "json"
+).lower()
+LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATES: Dict[str, float] = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+
+log_writer = configure_logging(
+    fmt=LOG_FORMAT,
+    level=LOG_LEVEL,
+    sample_rates=LOG_SAMPLE_RATES,
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000")),
 )
 
 log = structlog.get_logger()
@@ -54,12 +87,61 @@ log = structlog.get_logger()
 
 APP_VERSION = "1.0.0"
 GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+# Optional pool of keys / projects: "key[*weight][@endpoint],..." — overrides GEMINI_API_KEY
+GEMINI_API_KEYS: str = os.getenv("GEMINI_API_KEYS", "")
+GEMINI_POOL_STRATEGY: str = os.getenv("GEMINI_POOL_STRATEGY", "least_loaded")
+GEMINI_KEY_RPM: int | None = int(os.getenv("GEMINI_KEY_RPM", "0")) or None
+GEMINI_KEY_COOLDOWN_SECONDS: float = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", "30"))
+# Blocking SDK threads per key — the cap on concurrent upstream calls is this × keys
+GEMINI_THREADS_PER_KEY: int = int(os.getenv("GEMINI_THREADS_PER_KEY", "16"))
 GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+# Upstream cache of SYSTEM_PROMPT per key (0 = off). The TTL is refreshed at half-life.
+GEMINI_PROMPT_CACHE_TTL_SECONDS: float = float(os.getenv("GEMINI_PROMPT_CACHE_TTL_SECONDS", "0"))
+# Ask Gemini for just the missing fields when a truncated reply can't be repaired locally
+GEMINI_REPAIR_FOLLOWUP: bool = os.getenv("GEMINI_REPAIR_FOLLOWUP", "true").lower() == "true"
 HOST: str = os.getenv("HOST", "0.0.0.0")
 PORT: int = int(os.getenv("PORT", "8000"))
 ENV: str = os.getenv("ENV", "development")
 MAX_IMAGE_SIZE_BYTES: int = int(os.getenv("MAX_IMAGE_SIZE_BYTES", str(10 * 1024 * 1024)))
 
+# Completed analyses, keyed by SHA-256 of the uploaded bytes (per worker)
+RESULT_STORE_MAX_ENTRIES: int = int(os.getenv("RESULT_STORE_MAX_ENTRIES", "10000"))
+RESULT_STORE_TTL_SECONDS: float = float(os.getenv("RESULT_STORE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Resumable uploads — spooled to disk, bounded by declared size, expire when idle
+UPLOAD_SPOOL_DIR: str | None = os.getenv("UPLOAD_SPOOL_DIR") or None
+UPLOAD_MAX_DISK_BYTES: int = int(os.getenv("UPLOAD_MAX_DISK_BYTES", str(512 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_SECONDS: float = float(os.getenv("UPLOAD_SESSION_TTL_SECONDS", "3600"))
+UPLOAD_MAX_CHUNK_BYTES: int = int(os.getenv("UPLOAD_MAX_CHUNK_BYTES", str(1024 * 1024)))
+
+# Vision backend — "gemini" (live), "record" (live + write cassettes), "replay" (offline)
+VISION_BACKEND: str = os.getenv("VISION_BACKEND", "gemini").lower()
+VISION_CASSETTE_DIR: str = os.getenv("VISION_CASSETTE_DIR", "cassettes")
+_replay_latency = os.getenv("VISION_REPLAY_LATENCY_MS", "original")
+VISION_REPLAY_LATENCY_MS: float | None = (
+    None if _replay_latency == "original" else float(_replay_latency)
+)
+VISION_REPLAY_STRICT: bool = os.getenv("VISION_REPLAY_STRICT", "true").lower() == "true"
+IMAGE_MEMORY_BUDGET_BYTES: int = int(
+    os.getenv("IMAGE_MEMORY_BUDGET_BYTES", str(512 * 1024 * 1024))
+)
+IMAGE_MEMORY_WAIT_SECONDS: float = float(os.getenv("IMAGE_MEMORY_WAIT_SECONDS", "5"))
+
+# Local blur / exposure / size gate — "enforce" rejects, "warn" only annotates, "off" skips.
+# Defaults to "warn" until the thresholds are calibrated on labelled meal photos.
+IMAGE_QUALITY_MODE: str = os.getenv("IMAGE_QUALITY_MODE", "warn").lower()
+IMAGE_QUALITY_THRESHOLDS: QualityThresholds | None = (
+    None
+    if IMAGE_QUALITY_MODE == "off"
+    else QualityThresholds(
+        min_side_px=int(os.getenv("IMAGE_QUALITY_MIN_SIDE_PX", "224")),
+        blur_reject_var=float(os.getenv("IMAGE_QUALITY_BLUR_MIN_VAR", "15")),
+        dark_reject_mean=float(os.getenv("IMAGE_QUALITY_DARK_MIN_MEAN", "28")),
+        bright_reject_mean=float(os.getenv("IMAGE_QUALITY_BRIGHT_MAX_MEAN", "235")),
+        enforce=IMAGE_QUALITY_MODE == "enforce",
+    )
+)
+
 _raw_origins = os.getenv(
     "ALLOWED_ORIGINS",
     "http://localhost:8081,http://localhost:19006,http://localhost:3000",
@@ -69,6 +151,29 @@ ALLOWED_ORIGINS: list[str] = [o.strip() for o in _raw_origins.split(",") if o.st
 # ─── Global service instance (set during lifespan startup) ────────────────────
 
 gemini_service: GeminiNutritionService | None = None
+upstream_pool: BackendPool | None = None
+prompt_caches: list[PromptCache] = []
+
+# Input tokens / latency per upstream call, with vs without the cached prefix
+prompt_cache_stats = PromptCacheStats()
+
+# Process-wide byte budget for decoded frames / buffers held by /analyze
+image_budget = ImageMemoryBudget(
+    capacity_bytes=IMAGE_MEMORY_BUDGET_BYTES,
+    wait_timeout_s=IMAGE_MEMORY_WAIT_SECONDS,
+)
+
+result_store = ResultStore(
+    max_entries=RESULT_STORE_MAX_ENTRIES,
+    ttl_s=RESULT_STORE_TTL_SECONDS,
+)
+
+upload_sessions = UploadSessionManager(
+    spool_dir=UPLOAD_SPOOL_DIR,
+    max_session_bytes=MAX_IMAGE_SIZE_BYTES,
+    max_total_bytes=UPLOAD_MAX_DISK_BYTES,
+    ttl_s=UPLOAD_SESSION_TTL_SECONDS,
+)
 
 
 # ─── Lifespan ─────────────────────────────────────────────────────────────────
@@ -80,27 +185,86 @@ async def lifespan(app: FastAPI):
     global gemini_service
 
     # ── Startup ──────────────────────────────────────────────────────────────
-    if not GEMINI_API_KEY:
+    if not (GEMINI_API_KEY or GEMINI_API_KEYS) and VISION_BACKEND != "replay":
         log.error("GEMINI_API_KEY is not set — /analyze will be unavailable.")
     else:
         try:
             gemini_service = GeminiNutritionService(
-                api_key=GEMINI_API_KEY,
-                model_name=GEMINI_MODEL,
+                backend=_build_vision_backend(),
+                repair_followup=GEMINI_REPAIR_FOLLOWUP,
             )
             log.info(
                 "Gemini service ready",
-                model=GEMINI_MODEL,
+                model=gemini_service.model_name,
+                backend=VISION_BACKEND,
                 env=ENV,
                 origins=ALLOWED_ORIGINS,
             )
         except Exception as exc:
             log.error("Failed to initialise Gemini service", error=str(exc))
 
+    refresher: asyncio.Task | None = None
+    if prompt_caches:
+        # Create caches before serving; a failure just leaves that key uncached
+        loop = asyncio.get_running_loop()
+        names = await asyncio.gather(
+            *(loop.run_in_executor(None, cache.ensure) for cache in prompt_caches)
+        )
+        log.info(
+            "Prompt caches ready",
+            active=sum(1 for n in names if n),
+            total=len(prompt_caches),
+            ttl_s=prompt_caches[0].ttl_s,
+        )
+        refresher = asyncio.create_task(
+            keep_prompt_caches_warm(prompt_caches, min(c.ttl_s for c in prompt_caches) / 2)
+        )
+
     yield  # App is running
 
     # ── Shutdown ─────────────────────────────────────────────────────────────
     log.info("iGo Vision AI shutting down.")
+    if refresher is not None:
+        refresher.cancel()
+    for cache in prompt_caches:
+        cache.delete()
+    upload_sessions.close()
+    if log_writer is not None:
+        log_writer.close()
+
+
+def _build_vision_backend() -> VisionBackend:
+    """Construct the backend selected by VISION_BACKEND."""
+    global upstream_pool
+
+    if VISION_BACKEND == "replay":
+        return ReplayBackend(
+            VISION_CASSETTE_DIR,
+            model_name=GEMINI_MODEL,
+            latency_ms=VISION_REPLAY_LATENCY_MS,
+            strict=VISION_REPLAY_STRICT,
+            config=REQUEST_CONFIG_DIGEST,
+        )
+    key_specs = parse_key_specs(GEMINI_API_KEYS) or [(GEMINI_API_KEY, 1.0, None)]
+    upstream_pool = build_gemini_pool(
+        key_specs,
+        model_name=GEMINI_MODEL,
+        strategy=GEMINI_POOL_STRATEGY,
+        rpm_limit=GEMINI_KEY_RPM,
+        cooldown_s=GEMINI_KEY_COOLDOWN_SECONDS,
+        threads_per_key=GEMINI_THREADS_PER_KEY,
+        prompt_cache_ttl_s=GEMINI_PROMPT_CACHE_TTL_SECONDS or None,
+        cache_stats=prompt_cache_stats,
+    )
+    prompt_caches[:] = [
+        m.backend.prompt_cache for m in upstream_pool.members if m.backend.prompt_cache
+    ]
+    live: VisionBackend = upstream_pool
+    if VISION_BACKEND == "record":
+        return RecordingBackend(live, VISION_CASSETTE_DIR, config=REQUEST_CONFIG_DIGEST)
+    if VISION_BACKEND != "gemini":
+        raise ValueError(f"Unknown VISION_BACKEND: {VISION_BACKEND!r}")
+    return live
 
 
 # ─── App factory ──────────────────────────────────────────────────────────────
@@ -121,8 +285,9 @@ def create_app() -> FastAPI:
         CORSMiddleware,
         allow_origins=ALLOWED_ORIGINS,
         allow_credentials=True,
-        allow_methods=["GET", "POST", "OPTIONS"],
+        allow_methods=["GET", "HEAD", "POST", "PATCH", "OPTIONS"],
         allow_headers=["*"],
+        expose_headers=["ETag", "Upload-Offset", "Location"],
     )
 
     # ── Request logging middleware ────────────────────────────────────────────
@@ -166,7 +331,10 @@ def create_app() -> FastAPI:
             "environment": ENV,
             "docs": "/docs",
             "health": "/health",
+            "metrics": "/metrics",
             "analyze": "POST /analyze",
+            "analysis": "GET /analysis/{sha256}",
+            "uploads": "POST /uploads",
         }
 
     @app.get("/health", response_model=HealthResponse, tags=["Meta"])
@@ -174,19 +342,67 @@ def create_app() -> FastAPI:
         """
         Readiness probe endpoint.
         Returns 200 when the service is operational, 503 if Gemini is unavailable.
+        Status is "degraded" while any upstream key is ejected or rate-limited.
         """
         if gemini_service is None:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="Gemini service is not initialised. Check GEMINI_API_KEY.",
             )
+        upstream = upstream_pool.health() if upstream_pool is not None else None
+        degraded = upstream is not None and not all(k["available"] for k in upstream)
         return HealthResponse(
-            status="ok",
+            status="degraded" if degraded else "ok",
             version=APP_VERSION,
-            model=GEMINI_MODEL,
+            model=gemini_service.model_name,
             environment=ENV,
+            upstream=upstream,
         )
 
+    @app.get("/metrics", response_model=Dict[str, Any], tags=["Meta"])
+    async def metrics():
+        """Runtime counters for dashboards / alerting."""
+        counters: Dict[str, Any] = {
+            "image_memory": image_budget.snapshot(),
+            "result_store": result_store.snapshot(),
+            "uploads": upload_sessions.snapshot(),
+        }
+        if gemini_service is not None:
+            counters["repair"] = gemini_service.repair_stats()
+        if upstream_pool is not None:
+            counters["prompt_cache"] = {
+                **prompt_cache_stats.snapshot(),
+                "caches": {
+                    m.label: m.backend.prompt_cache.snapshot()
+                    for m in upstream_pool.members
+                    if m.backend.prompt_cache
+                },
+            }
+        if log_writer is not None:
+            counters["logging"] = log_writer.snapshot()
+        return counters
+
+    @app.api_route(
+        "/analysis/{sha256}",
+        methods=["GET", "HEAD"],
+        response_model=AnalyzeResponse,
+        tags=["Nutrition"],
+        summary="Look up a stored analysis by image hash",
+        description=(
+            "SHA-256 (hex) of the exact image bytes the client would upload. "
+            "200 with the stored result, or 404 — then upload via POST /analyze."
+        ),
+    )
+    async def get_analysis(sha256: str, response: Response):
+        digest = normalise_hash(sha256)
+        if digest is None:
+            _raise_400("Expected a hex-encoded SHA-256 digest.", "IMAGE_HASH_INVALID")
+        stored = _lookup_result(digest)
+        if stored is None:
+            _raise_404("No stored analysis for this image.", "ANALYSIS_NOT_FOUND")
+        response.headers["ETag"] = f'"{digest}"'
+        return stored
+
     @app.post(
         "/analyze",
         response_model=AnalyzeResponse,
@@ -194,27 +410,49 @@ def create_app() -> FastAPI:
         tags=["Nutrition"],
         summary="Analyse a meal image",
         description=(
-            "Upload a JPEG, PNG, or WebP image of a meal. "
-            "Returns a comprehensive AI-generated nutritional breakdown."
+            "Upload a JPEG, PNG, WebP, or HEIC image of a meal. "
+            "Returns a comprehensive AI-generated nutritional breakdown. "
+            "Send `X-Image-SHA256: <sha256>` to get a stored result without "
+            "uploading; on a miss (404 ANALYSIS_NOT_FOUND) retry with the image."
         ),
     )
     async def analyze_meal(
-        image: UploadFile = File(
-            ..., description="Meal photo. JPEG / PNG / WebP, max 10 MB."
+        response: Response,
+        image: UploadFile | None = File(
+            None, description="Meal photo. JPEG / PNG / WebP / HEIC, max 10 MB."
+        ),
+        x_image_sha256: str | None = Header(
+            None, description="Hex SHA-256 of the exact image bytes, e.g. 3b1f…"
         ),
     ):
         """
         Main endpoint — receives an image, validates it, calls Gemini, and returns
         a structured NutritionAnalysis with processing metadata.
         """
-        # ── 1. Check service availability ────────────────────────────────────
+        # ── 1. Hash-first: answer from stored results without image bytes ────
+        # (A dedicated header rather than If-None-Match: conditional-request
+        # semantics would make a match on POST a 412, the opposite of this.)
+        if x_image_sha256:
+            digest = normalise_hash(x_image_sha256)
+            if digest is None:
+                _raise_400("X-Image-SHA256 must be a hex SHA-256 digest.", "IMAGE_HASH_INVALID")
+            stored = _lookup_result(digest)
+            if stored is not None:
+                response.headers["ETag"] = f'"{digest}"'
+                return stored
+            if image is None:
+                _raise_404("No stored analysis for this image. Upload it.", "ANALYSIS_NOT_FOUND")
+        if image is None:
+            _raise_400("No image uploaded.", "IMAGE_MISSING")
+
+        # ── 2. Check service availability ────────────────────────────────────
         if gemini_service is None:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="AI service unavailable. Please try again later.",
             )
 
-        # ── 2. Read and validate image bytes ─────────────────────────────────
+        # ── 3. Read image bytes ──────────────────────────────────────────────
         try:
             raw_bytes = await image.read()
         except Exception as exc:
@@ -223,62 +461,320 @@ def create_app() -> FastAPI:
                 detail=f"Failed to read uploaded file: {exc}",
             )
 
+        # ── 4. Validate, analyse and store ───────────────────────────────────
+        result = await _analyze_bytes(raw_bytes, image.filename)
+        response.headers["ETag"] = f'"{result.image_sha256}"'
+        return result
+
+    # ── Resumable uploads ─────────────────────────────────────────────────────
+
+    @app.post(
+        "/uploads",
+        response_model=UploadSessionResponse,
+        status_code=status.HTTP_201_CREATED,
+        tags=["Uploads"],
+        summary="Start a resumable image upload",
+    )
+    async def create_upload(body: UploadCreateRequest, response: Response):
         try:
-            b64_image, mime_type, dimensions = process_upload(
-                data=raw_bytes,
-                max_size=MAX_IMAGE_SIZE_BYTES,
+            session = upload_sessions.create(
+                size=body.size, filename=body.filename, sha256=body.sha256
             )
+        except UploadStorageFull as exc:
+            _raise_503(str(exc), "UPLOAD_STORAGE_FULL")
         except ValueError as exc:
-            _raise_400(str(exc), "IMAGE_INVALID")
-
-        log.info(
-            "Image accepted",
-            filename=image.filename,
-            size_kb=round(len(raw_bytes) / 1024, 1),
-            dimensions=dimensions,
-            mime=mime_type,
-        )
-
-        # ── 3. Call Gemini ────────────────────────────────────────────────────
+            _raise_413(str(exc), "IMAGE_TOO_LARGE")
+        response.headers["Location"] = f"/uploads/{session.upload_id}"
+        response.headers["Upload-Offset"] = "0"
+        return _session_response(session)
+
+    @app.api_route(
+        "/uploads/{upload_id}",
+        methods=["GET", "HEAD"],
+        response_model=UploadSessionResponse,
+        tags=["Uploads"],
+        summary="Current offset of an upload — resume from here",
+    )
+    async def get_upload(upload_id: str, response: Response):
+        session = _get_session(upload_id, resuming=True)
+        response.headers["Upload-Offset"] = str(session.offset)
+        return _session_response(session)
+
+    @app.patch(
+        "/uploads/{upload_id}",
+        response_model=UploadSessionResponse,
+        tags=["Uploads"],
+        summary="Append a chunk at Upload-Offset",
+    )
+    async def patch_upload(
+        upload_id: str,
+        request: Request,
+        response: Response,
+        upload_offset: int = Header(..., ge=0, description="Byte offset of this chunk"),
+    ):
+        chunk = await _read_chunk(request)
         try:
-            analysis, processing_ms = await gemini_service.analyze(
-                image_b64=b64_image,
-                mime_type=mime_type,
-                image_dimensions=dimensions,
+            session = await upload_sessions.append(upload_id, upload_offset, chunk)
+        except UploadSessionNotFound:
+            _raise_404("Upload session not found or expired.", "UPLOAD_NOT_FOUND")
+        except UploadOffsetMismatch as exc:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail={
+                    "success": False,
+                    "error_code": "UPLOAD_OFFSET_MISMATCH",
+                    "message": str(exc),
+                },
+                headers={"Upload-Offset": str(exc.expected)},
             )
         except ValueError as exc:
-            log.error("Gemini analysis failed", error=str(exc))
-            _raise_422(str(exc), "AI_PARSE_ERROR")
-        except Exception as exc:
-            error_str = str(exc).lower()
-            if "resource_exhausted" in error_str or "quota" in error_str:
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    detail="API quota exceeded. Please try again later.",
-                )
-            if "invalid_argument" in error_str:
-                _raise_400("Gemini could not process this image.", "IMAGE_REJECTED")
-            log.error("Unexpected Gemini error", error=str(exc))
+            _raise_400(str(exc), "UPLOAD_INVALID")
+        response.headers["Upload-Offset"] = str(session.offset)
+        return _session_response(session)
+
+    @app.post(
+        "/uploads/{upload_id}/finalize",
+        response_model=AnalyzeResponse,
+        tags=["Uploads"],
+        summary="Analyse a completed upload",
+        description="Runs the assembled image through the same pipeline as POST /analyze.",
+    )
+    async def finalize_upload(upload_id: str, response: Response):
+        session = _get_session(upload_id)
+
+        # Retried finalize (e.g. the first response was lost on the way back)
+        if session.completed_digest:
+            stored = _lookup_result(session.completed_digest)
+            if stored is None:
+                _raise_404("Upload already finalised and result expired.", "UPLOAD_NOT_FOUND")
+            response.headers["ETag"] = f'"{session.completed_digest}"'
+            return stored
+
+        if gemini_service is None:
             raise HTTPException(
-                status_code=status.HTTP_502_BAD_GATEWAY,
-                detail="AI service returned an unexpected error.",
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="AI service unavailable. Please try again later.",
             )
 
+        # A finalize retried while the first is still running (client timed
+        # out, or double-tapped) joins it instead of analysing the image again.
+        # The task is shielded so a dropped connection does not cancel it.
+        if session.finalize_task is None:
+            session.finalize_task = asyncio.create_task(_finalize(session))
+            session.finalize_task.add_done_callback(
+                lambda task: _finalize_done(session, task)
+            )
+        result = await asyncio.shield(session.finalize_task)
+        response.headers["ETag"] = f'"{result.image_sha256}"'
+        return result
+
+    return app
+
+
+# ─── Upload session helpers ───────────────────────────────────────────────────
+
+
+def _get_session(upload_id: str, resuming: bool = False) -> UploadSession:
+    try:
+        return upload_sessions.get(upload_id, resuming=resuming)
+    except UploadSessionNotFound:
+        _raise_404("Upload session not found or expired.", "UPLOAD_NOT_FOUND")
+
+
+async def _read_chunk(request: Request) -> bytes:
+    """
+    Read a PATCH body, refusing anything over UPLOAD_MAX_CHUNK_BYTES. A declared
+    Content-Length is checked up front; a chunked body without one is streamed
+    and cut off as soon as it crosses the limit instead of buffered whole.
+    """
+    declared = request.headers.get("content-length")
+    if declared is not None:
+        if not declared.isdigit():
+            _raise_400(
+                "Content-Length must be a non-negative integer.", "CONTENT_LENGTH_INVALID"
+            )
+        if int(declared) > UPLOAD_MAX_CHUNK_BYTES:
+            _raise_413(f"Chunk exceeds {UPLOAD_MAX_CHUNK_BYTES} bytes.", "CHUNK_TOO_LARGE")
+
+    chunk = bytearray()
+    async for piece in request.stream():
+        chunk += piece
+        if len(chunk) > UPLOAD_MAX_CHUNK_BYTES:
+            _raise_413(f"Chunk exceeds {UPLOAD_MAX_CHUNK_BYTES} bytes.", "CHUNK_TOO_LARGE")
+    return bytes(chunk)
+
+
+async def _finalize(session: UploadSession) -> AnalyzeResponse:
+    upload_id = session.upload_id
+    try:
+        raw_bytes = await upload_sessions.read_complete(upload_id)
+    except UploadSessionNotFound:
+        _raise_404("Upload session not found or expired.", "UPLOAD_NOT_FOUND")
+    except ValueError as exc:
+        _raise_400(str(exc), "UPLOAD_INCOMPLETE")
+
+    try:
+        result = await _analyze_bytes(raw_bytes, session.filename)
+    except HTTPException as exc:
+        # The image itself was rejected — no point keeping it for a retry
+        if 400 <= exc.status_code < 500 and exc.status_code != 429:
+            upload_sessions.discard(upload_id)
+        raise
+
+    upload_sessions.mark_done(upload_id, result.image_sha256)
+    return result
+
+
+def _finalize_done(session: UploadSession, task: asyncio.Task) -> None:
+    # Failed attempts are forgotten so a later retry starts afresh; retrieving
+    # the exception here also keeps asyncio from logging it as unhandled.
+    if task.cancelled() or task.exception() is not None:
+        session.finalize_task = None
+
+
+def _session_response(session: UploadSession) -> UploadSessionResponse:
+    remaining = upload_sessions.ttl_s - (time.monotonic() - session.touched_at)
+    return UploadSessionResponse(
+        upload_id=session.upload_id,
+        size=session.size,
+        offset=session.offset,
+        complete=session.complete,
+        expires_in_s=max(0, int(remaining)),
+    )
+
+
+# ─── Analyze pipeline ─────────────────────────────────────────────────────────
+
+
+def _lookup_result(digest: str) -> AnalyzeResponse | None:
+    """Stored AnalyzeResponse for an image hash, marked as cached, or None."""
+    payload = result_store.get(digest)
+    if payload is None:
+        return None
+    return AnalyzeResponse.model_validate({**payload, "cached": True})
+
+
+async def _analyze_bytes(raw_bytes: bytes, filename: str | None) -> AnalyzeResponse:
+    """
+    Analyse raw upload bytes end to end: dedupe by SHA-256, admit against the
+    memory budget, process + call Gemini, and store the result.
+    Raises HTTPException on failure.
+    """
+    digest = sha256_hex(raw_bytes)
+    stored = _lookup_result(digest)
+    if stored is not None:
+        log.info("Analysis served from store", filename=filename, sha256=digest[:12])
+        return stored
+
+    try:
+        estimated_bytes = estimate_processing_bytes(raw_bytes)
+    except ValueError as exc:
+        _raise_400(str(exc), "IMAGE_INVALID")
+
+    try:
+        async with image_budget.reserve(estimated_bytes) as reservation:
+            b64_image, mime_type, dimensions, quality_warnings = await _prepare_image(
+                raw_bytes, filename
+            )
+            # Decoded frames are gone; only the upload and its base64 payload
+            # stay alive through the (multi-second) Gemini call
+            await reservation.shrink(len(raw_bytes) + len(b64_image))
+            analysis, processing_ms = await _call_gemini(b64_image, mime_type, dimensions)
+    except MemoryBudgetExceeded as exc:
+        if exc.too_large:
+            _raise_413(str(exc), "IMAGE_TOO_LARGE")
+        _raise_503(str(exc), "SERVER_BUSY")
+
+    log.info(
+        "Analysis complete",
+        meal=analysis.meal_name,
+        score=analysis.health_score,
+        ms=processing_ms,
+    )
+
+    result = AnalyzeResponse(
+        success=True,
+        data=analysis,
+        processing_time_ms=processing_ms,
+        model_used=gemini_service.model_name,
+        quality_warnings=quality_warnings or None,
+        image_sha256=digest,
+    )
+    result_store.put(digest, result.model_dump(mode="json"))
+    return result
+
+
+async def _prepare_image(raw_bytes: bytes, filename: str | None):
+    """
+    Decode / resize / quality-check / encode the upload in a worker thread so
+    the event loop keeps serving other requests. Returns
+    (b64_image, mime_type, dimensions, quality_warnings); raises HTTPException.
+    Callers must hold an `image_budget` reservation for the duration.
+    """
+    try:
+        b64_image, mime_type, dimensions, quality, decode = await asyncio.to_thread(
+            process_upload,
+            data=raw_bytes,
+            max_size=MAX_IMAGE_SIZE_BYTES,
+            quality=IMAGE_QUALITY_THRESHOLDS,
+        )
+    except ImageQualityError as exc:
         log.info(
-            "Analysis complete",
-            meal=analysis.meal_name,
-            score=analysis.health_score,
-            ms=processing_ms,
+            "Image rejected by quality gate",
+            filename=filename,
+            code=exc.code,
+            blur=exc.report.blur_variance,
+            luminance=exc.report.mean_luminance,
+            quality_ms=exc.report.elapsed_ms,
         )
+        _raise_400(str(exc), exc.code)
+    except ValueError as exc:
+        _raise_400(str(exc), "IMAGE_INVALID")
+
+    quality_warnings = quality.warnings if quality else []
+
+    log.info(
+        "Image accepted",
+        filename=filename,
+        size_kb=round(len(raw_bytes) / 1024, 1),
+        dimensions=dimensions,
+        mime=mime_type,
+        source_format=decode.source_format,
+        decode_ms=decode.decode_ms,
+        resize_ms=decode.resize_ms,
+        quality_warnings=quality_warnings,
+        quality_ms=quality.elapsed_ms if quality else None,
+    )
+    return b64_image, mime_type, dimensions, quality_warnings
+
 
-        return AnalyzeResponse(
-            success=True,
-            data=analysis,
-            processing_time_ms=processing_ms,
-            model_used=GEMINI_MODEL,
+async def _call_gemini(b64_image: str, mime_type: str, dimensions):
+    """Run a prepared image through Gemini. Returns (NutritionAnalysis, processing_ms)."""
+    try:
+        analysis, processing_ms = await gemini_service.analyze(
+            image_b64=b64_image,
+            mime_type=mime_type,
+            image_dimensions=dimensions,
+        )
+    except ValueError as exc:
+        log.error("Gemini analysis failed", error=str(exc))
+        _raise_422(str(exc), "AI_PARSE_ERROR")
+    except Exception as exc:
+        error_str = str(exc).lower()
+        if "resource_exhausted" in error_str or "quota" in error_str:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="API quota exceeded. Please try again later.",
+            )
+        if "invalid_argument" in error_str:
+            _raise_400("Gemini could not process this image.", "IMAGE_REJECTED")
+        log.error("Unexpected Gemini error", error=str(exc))
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="AI service returned an unexpected error.",
         )
 
-    return app
+    return analysis, processing_ms
 
 
 # ─── HTTP error helpers ───────────────────────────────────────────────────────
@@ -291,6 +787,20 @@ def _raise_400(message: str, code: str = "BAD_REQUEST") -> None:
     )
 
 
+def _raise_404(message: str, code: str = "NOT_FOUND") -> None:
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail={"success": False, "error_code": code, "message": message},
+    )
+
+
+def _raise_413(message: str, code: str = "PAYLOAD_TOO_LARGE") -> None:
+    raise HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail={"success": False, "error_code": code, "message": message},
+    )
+
+
 def _raise_422(message: str, code: str = "UNPROCESSABLE") -> None:
     raise HTTPException(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -298,6 +808,14 @@ def _raise_422(message: str, code: str = "UNPROCESSABLE") -> None:
     )
 
 
+def _raise_503(message: str, code: str = "SERVICE_UNAVAILABLE") -> None:
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail={"success": False, "error_code": code, "message": message},
+        headers={"Retry-After": "2"},
+    )
+
+
 # ─── Entry point ──────────────────────────────────────────────────────────────
 
 app = create_app()
@@ -7,6 +7,7 @@ Covers:
   - AnalyzeResponse  – top-level API envelope sent to the frontend
   - ErrorDetail      – standardised error payload
   - HealthResponse   – /health check response body
+  - UploadCreateRequest / UploadSessionResponse – resumable upload sessions
 """
 
 from __future__ import annotations
@@ -182,6 +183,16 @@ class AnalyzeResponse(BaseModel):
     model_used: Optional[str] = Field(
         default=None, description="Gemini model identifier used for this analysis"
     )
+    quality_warnings: Optional[List[str]] = Field(
+        default=None,
+        description="Soft image-quality issues, e.g. IMAGE_TOO_BLURRY, SUBJECT_TOO_SMALL",
+    )
+    image_sha256: Optional[str] = Field(
+        default=None, description="SHA-256 of the uploaded image bytes (also sent as ETag)"
+    )
+    cached: bool = Field(
+        default=False, description="True when served from a stored result without a Gemini call"
+    )
 
 
 # ─── Error Model ──────────────────────────────────────────────────────────────
@@ -205,8 +216,49 @@ class ErrorDetail(BaseModel):
 # ─── Health Check ─────────────────────────────────────────────────────────────
 
 
+class UpstreamKeyHealth(BaseModel):
+    """Per-key state of the upstream Gemini pool (keys are never exposed)."""
+
+    label: str
+    weight: float
+    available: bool
+    ejected_for_s: float
+    in_flight: int
+    requests_last_minute: int
+    rpm_limit: Optional[int] = None
+    requests_total: int
+    errors_total: int
+    quota_errors_total: int
+
+
 class HealthResponse(BaseModel):
     status: str = "ok"
     version: str = "1.0.0"
     model: str
     environment: str
+    upstream: Optional[List[UpstreamKeyHealth]] = None
+
+
+# ─── Resumable Uploads ────────────────────────────────────────────────────────
+
+
+class UploadCreateRequest(BaseModel):
+    """Body of POST /uploads."""
+
+    size: int = Field(..., gt=0, description="Total image size in bytes")
+    filename: Optional[str] = Field(default=None, max_length=255)
+    sha256: Optional[str] = Field(
+        default=None,
+        pattern=r"^[0-9a-f]{64}$",
+        description="Optional SHA-256 of the full image, verified on finalize",
+    )
+
+
+class UploadSessionResponse(BaseModel):
+    """State of a resumable upload session."""
+
+    upload_id: str
+    size: int
+    offset: int = Field(..., description="Bytes received so far — resume from here")
+    complete: bool
+    expires_in_s: int
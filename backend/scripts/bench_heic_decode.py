@@ -0,0 +1,116 @@
+"""
+Benchmark server-side HEIC decode against client-side JPEG conversion.
+
+For each HEIC file, compares what it costs to get the photo into the
+pipeline when:
+
+  heic upload        — phone uploads the original .heic; server decodes it
+                       (utils.image.decode_image)
+  client jpeg (full) — phone transcodes to full-size JPEG q90, uploads that;
+                       server decodes the JPEG
+  client jpeg (2048) — phone transcodes and downsizes to 2048 px first
+
+Client conversion time is measured on this machine as a proxy (phones are
+slower and pay for it in battery); upload time assumes --uplink-mbps.
+
+Run from the backend directory:
+  python -m scripts.bench_heic_decode photos/*.heic
+  python -m scripts.bench_heic_decode --synthetic 3   # generated 12 MP images
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from utils.image import MAX_DIMENSION, decode_image, pillow_heif, resize_if_needed
+
+SCENARIOS = ("heic upload", "client jpeg (full)", "client jpeg (2048)")
+
+
+def _synthetic_heic(seed: int) -> bytes:
+    """12 MP photo-like frame (multi-scale colour texture) as HEIC."""
+    rng = np.random.default_rng(seed)
+    pixels = np.zeros((3024, 4032, 3), dtype=np.float32)
+    for cells, amplitude in ((24, 1.0), (96, 0.35), (384, 0.15)):
+        layer = Image.fromarray(
+            rng.integers(0, 255, (cells * 3 // 4, cells, 3), dtype=np.uint8)
+        ).resize((4032, 3024), Image.BICUBIC)
+        pixels += amplitude * np.asarray(layer, dtype=np.float32)
+    img = Image.fromarray(np.clip(pixels / 1.5, 0, 255).astype(np.uint8))
+    exif = img.getexif()
+    exif[0x0112] = 6  # Portrait capture, stored landscape — like an iPhone
+    buf = io.BytesIO()
+    # q60 lands near the HEIC:JPEG size ratio of real iPhone captures
+    pillow_heif.from_pillow(img).save(buf, quality=60, exif=exif.tobytes())
+    return buf.getvalue()
+
+
+def _client_jpeg(heic: bytes, max_dim: int | None) -> tuple[bytes, float]:
+    t0 = time.perf_counter()
+    img = pillow_heif.open_heif(heic).to_pillow()
+    if max_dim is not None:
+        img = resize_if_needed(img, max_dim)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue(), (time.perf_counter() - t0) * 1000
+
+
+def _server_ms(data: bytes) -> float:
+    t0 = time.perf_counter()
+    decode_image(data)
+    return (time.perf_counter() - t0) * 1000
+
+
+def _measure(heic: bytes) -> Dict[str, Dict[str, float]]:
+    full_jpeg, full_ms = _client_jpeg(heic, None)
+    small_jpeg, small_ms = _client_jpeg(heic, MAX_DIMENSION)
+    return {
+        "heic upload": {"bytes": len(heic), "client_ms": 0.0, "server_ms": _server_ms(heic)},
+        "client jpeg (full)": {
+            "bytes": len(full_jpeg), "client_ms": full_ms, "server_ms": _server_ms(full_jpeg)
+        },
+        "client jpeg (2048)": {
+            "bytes": len(small_jpeg), "client_ms": small_ms, "server_ms": _server_ms(small_jpeg)
+        },
+    }
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("files", nargs="*", type=Path, help="HEIC / HEIF files")
+    parser.add_argument("--synthetic", type=int, default=0, help="Generate N 12 MP test images")
+    parser.add_argument("--uplink-mbps", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    if pillow_heif is None:
+        print("pillow-heif is not installed — pip install pillow-heif")
+        return 1
+    samples = [path.read_bytes() for path in args.files]
+    samples += [_synthetic_heic(seed) for seed in range(args.synthetic)]
+    if not samples:
+        parser.error("pass HEIC files or --synthetic N")
+
+    runs = [_measure(data) for data in samples]
+    print(f"{len(runs)} image(s), uplink {args.uplink_mbps:g} Mbit/s — medians\n")
+    print(f"{'scenario':<22}{'upload KB':>10}{'client ms':>11}{'upload ms':>11}{'server ms':>11}{'total ms':>10}")
+    for scenario in SCENARIOS:
+        kb = statistics.median(r[scenario]["bytes"] for r in runs) / 1024
+        client = statistics.median(r[scenario]["client_ms"] for r in runs)
+        upload = kb * 1024 * 8 / (args.uplink_mbps * 1e6) * 1000
+        server = statistics.median(r[scenario]["server_ms"] for r in runs)
+        total = client + upload + server
+        print(f"{scenario:<22}{kb:>10.0f}{client:>11.0f}{upload:>11.0f}{server:>11.0f}{total:>10.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Benchmark per-request logging overhead of the console vs json pipelines.
+
+Each simulated request emits the same events as /analyze on the happy path
+("Image accepted", "Analysis complete", "request"). Output goes to /dev/null
+so only formatting and hand-off cost is measured, not terminal speed.
+
+Run from the backend directory:
+  python -m scripts.bench_logging --requests 20000
+  python -m scripts.bench_logging --sample "request=0.1,Image accepted=0.1"
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List
+
+import structlog
+
+from utils.logging_setup import configure_logging, parse_sample_rates
+
+
+def _emit_request(log, i: int) -> None:
+    log.info(
+        "Image accepted",
+        filename=f"meal_{i}.jpg",
+        size_kb=812.4,
+        dimensions=(1536, 2048),
+        mime="image/jpeg",
+        quality_warnings=[],
+        quality_ms=4.2,
+    )
+    log.info("Analysis complete", meal="Grilled Chicken Salad", score=87, ms=1842)
+    log.info("request", method="POST", path="/analyze", status=200, ms=1901)
+
+
+def _run(label: str, n: int, **config) -> float:
+    devnull = open(os.devnull, "wb")
+    if config.get("fmt") == "json":
+        writer = configure_logging(stream=devnull, **config)
+    else:
+        # Console mode prints to sys.stdout — point it at /dev/null too
+        writer = None
+        real_stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        configure_logging(**config)
+    log = structlog.get_logger()
+
+    for i in range(min(500, n)):  # warm-up (logger cache, JIT-ish paths)
+        _emit_request(log, i)
+
+    t0 = time.perf_counter()
+    for i in range(n):
+        _emit_request(log, i)
+    elapsed = time.perf_counter() - t0
+
+    if writer is not None:
+        writer.close()
+        stats = writer.snapshot()
+    else:
+        sys.stdout.close()
+        sys.stdout = real_stdout
+        stats = {}
+    devnull.close()
+
+    per_req_us = elapsed / n * 1e6
+    print(f"{label:<28}{per_req_us:10.1f} µs/request   {stats}")
+    return per_req_us
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--sample", default="request=0.1,Image accepted=0.1")
+    args = parser.parse_args(argv)
+
+    rates: Dict[str, float] = parse_sample_rates(args.sample)
+    results = {
+        "console (dev)": _run("console (dev)", args.requests, fmt="console"),
+        "json + queue": _run("json + queue", args.requests, fmt="json"),
+        "json + queue + sampling": _run(
+            "json + queue + sampling", args.requests, fmt="json", sample_rates=rates
+        ),
+    }
+    base = results["console (dev)"]
+    print()
+    for label, us in results.items():
+        print(f"{label:<28}{base / us:6.1f}× vs console")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
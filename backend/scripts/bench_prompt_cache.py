@@ -0,0 +1,106 @@
+"""
+Compare input tokens and latency with and without the cached SYSTEM_PROMPT.
+
+Starts the local Gemini stub in-process (cache semantics + per-token prefill
+latency), sends the same analyze request through an uncached and a cached
+backend, then expires the cache upstream to show the transparent fallback
+and re-creation.
+
+Run from the backend directory:
+  python -m scripts.bench_prompt_cache --calls 20 --prefill-ms-per-1k 40
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import sys
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List
+
+import uvicorn
+from PIL import Image
+
+from scripts.stub_gemini import create_stub_app
+from services.gemini_service import GeminiNutritionService, build_gemini_backend
+from services.prompt_cache import PromptCacheStats
+
+
+def _start_stub(port: int, prefill_ms_per_1k: float, latency_ms: float) -> uvicorn.Server:
+    app = create_stub_app(rpm=0, latency_ms=latency_ms, prefill_ms_per_1k=prefill_ms_per_1k)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def _sample_image() -> str:
+    buf = io.BytesIO()
+    Image.new("RGB", (512, 512), (180, 120, 60)).save(buf, format="JPEG")
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+async def _run(service: GeminiNutritionService, image_b64: str, calls: int) -> None:
+    for _ in range(calls):
+        await service.analyze(image_b64, "image/jpeg", (512, 512))
+
+
+def _print_bucket(label: str, bucket: Dict[str, Any]) -> None:
+    print(
+        f"{label:<22}{bucket['calls']:>6} calls   "
+        f"prompt {bucket['avg_prompt_tokens']!s:>7}   "
+        f"cached {bucket['avg_cached_tokens']!s:>7}   "
+        f"billable {bucket['avg_billable_input_tokens']!s:>7}   "
+        f"{bucket['avg_latency_ms']!s:>7} ms"
+    )
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--port", type=int, default=9101)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=40.0)
+    args = parser.parse_args(argv)
+
+    server = _start_stub(args.port, args.prefill_ms_per_1k, args.latency_ms)
+    endpoint = f"http://127.0.0.1:{args.port}"
+    image_b64 = _sample_image()
+
+    stats = PromptCacheStats()
+    plain = build_gemini_backend("bench-key", endpoint=endpoint, cache_stats=stats)
+    cached = build_gemini_backend(
+        "bench-key", endpoint=endpoint, prompt_cache_ttl_s=600, cache_stats=stats
+    )
+    if cached.prompt_cache.ensure() is None:
+        print(f"cache create failed: {cached.prompt_cache.last_error}")
+        return 1
+
+    asyncio.run(_run(GeminiNutritionService(backend=plain), image_b64, args.calls))
+    asyncio.run(_run(GeminiNutritionService(backend=cached), image_b64, args.calls))
+
+    # Expire upstream: the next call must fall back, then ensure() re-creates
+    urllib.request.urlopen(urllib.request.Request(f"{endpoint}/stub/expire-caches", method="POST"))
+    asyncio.run(_run(GeminiNutritionService(backend=cached), image_b64, 1))
+    recreated = cached.prompt_cache.ensure() is not None
+
+    report = stats.snapshot()
+    _print_bucket("without cached prefix", report["uncached"])
+    _print_bucket("with cached prefix", report["cached"])
+    print()
+    print(f"fallbacks after upstream expiry: {report['fallbacks_total']}   re-created: {recreated}")
+    with urllib.request.urlopen(f"{endpoint}/stats") as resp:
+        print(f"stub: {json.loads(resp.read())}")
+
+    server.should_exit = True
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
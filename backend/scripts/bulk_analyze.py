@@ -0,0 +1,367 @@
+"""
+Offline bulk analysis — run a directory or manifest of meal photos through the
+same pipeline as POST /analyze, without HTTP, and stream results to JSONL.
+
+Pipeline (memory stays flat regardless of corpus size):
+  walk (lazy)  →  process pool: read + sha256 + utils.image.process_upload
+               →  asyncio: GeminiNutritionService.analyze (bounded concurrency)
+               →  one JSON line per image, appended to the output file
+
+At most `--max-in-flight` images are between "read" and "written" at any time.
+
+Resume: the output file doubles as the checkpoint. On start it is scanned for
+paths and sha256s already written; those paths are skipped without being read,
+and images whose bytes hash to an already-analysed sha256 are skipped after
+hashing (before any decode or upstream call). Error lines are retried only
+with --retry-errors.
+
+Upstream selection follows the server's env vars (GEMINI_API_KEY[S],
+GEMINI_MODEL, GEMINI_POOL_STRATEGY, ...); --replay-dir uses cassettes instead.
+
+Run from the backend directory:
+  python -m scripts.bulk_analyze photos/ -o results.jsonl --workers 4 --concurrency 8
+  python -m scripts.bulk_analyze --manifest paths.txt -o results.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from services.backend_pool import is_quota_error
+from services.gemini_service import (
+    REQUEST_CONFIG_DIGEST,
+    GeminiNutritionService,
+    build_gemini_pool,
+    parse_key_specs,
+)
+from services.vision_backend import ReplayBackend
+from utils.image import ImageQualityError, QualityThresholds, process_upload
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif"}
+LATENCY_SAMPLES = 10_000  # Percentiles are over the most recent N images
+
+
+# ─── Input ────────────────────────────────────────────────────────────────────
+
+
+def iter_inputs(root: Optional[Path], manifest: Optional[Path]) -> Iterator[Path]:
+    """Lazily yield image paths from a directory tree or a manifest file."""
+    if manifest is not None:
+        with open(manifest, encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("{"):
+                    line = json.loads(line)["path"]
+                yield Path(line)
+        return
+
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                elif Path(entry.name).suffix.lower() in IMAGE_SUFFIXES:
+                    yield Path(entry.path)
+
+
+def load_checkpoint(output: Path, retry_errors: bool) -> Tuple[Set[str], Set[str]]:
+    """(done_paths, done_hashes) from an existing output file."""
+    done_paths: Set[str] = set()
+    done_hashes: Set[str] = set()
+    if not output.exists():
+        return done_paths, done_hashes
+    with open(output, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Torn last line from an interrupted run
+            if retry_errors and record.get("status") == "error":
+                continue
+            done_paths.add(record["path"])
+            if record.get("status") == "ok" and record.get("sha256"):
+                done_hashes.add(record["sha256"])
+    return done_paths, done_hashes
+
+
+# ─── Process-pool preprocessing ───────────────────────────────────────────────
+
+_worker_done_hashes: Set[str] = set()
+_worker_max_size: int = 0
+_worker_quality: Optional[QualityThresholds] = None
+
+
+def _init_worker(done_hashes: Set[str], max_size: int, quality: Optional[QualityThresholds]) -> None:
+    global _worker_done_hashes, _worker_max_size, _worker_quality
+    _worker_done_hashes = done_hashes
+    _worker_max_size = max_size
+    _worker_quality = quality
+
+
+def _preprocess(path: str) -> Dict[str, Any]:
+    """Runs in a worker process: read, hash, and process_upload one image."""
+    t0 = time.perf_counter()
+    result: Dict[str, Any] = {"path": path}
+    try:
+        data = Path(path).read_bytes()
+    except OSError as exc:
+        return {**result, "status": "error", "error_code": "READ_FAILED", "error": str(exc)}
+
+    digest = hashlib.sha256(data).hexdigest()
+    result["sha256"] = digest
+    if digest in _worker_done_hashes:
+        return {**result, "status": "skipped_duplicate"}
+
+    try:
+        b64, mime, dims, quality, _ = process_upload(data, _worker_max_size, _worker_quality)
+    except ImageQualityError as exc:
+        return {**result, "status": "error", "error_code": exc.code, "error": str(exc)}
+    except ValueError as exc:
+        return {**result, "status": "error", "error_code": "IMAGE_INVALID", "error": str(exc)}
+    except Exception as exc:
+        # Pillow / pillow-heif raise OSError, SyntaxError, ... on corrupt files
+        # (e.g. a truncated JPEG); one bad file must not abort the run.
+        return {**result, "status": "error", "error_code": "DECODE_FAILED", "error": repr(exc)}
+
+    result.update(
+        status="preprocessed",
+        image_b64=b64,
+        mime_type=mime,
+        dimensions=list(dims),
+        quality_warnings=quality.warnings if quality else [],
+        preprocess_ms=int((time.perf_counter() - t0) * 1000),
+    )
+    return result
+
+
+# ─── Runner ───────────────────────────────────────────────────────────────────
+
+
+class BulkRunner:
+    def __init__(
+        self,
+        service: GeminiNutritionService,
+        output: Path,
+        workers: int,
+        concurrency: int,
+        max_in_flight: int,
+        max_retries: int,
+        done_hashes: Set[str],
+        max_size: int,
+        quality: Optional[QualityThresholds],
+    ) -> None:
+        self.service = service
+        self.output = output
+        self.max_retries = max_retries
+        self.done_hashes = done_hashes
+
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(done_hashes, max_size, quality),
+        )
+        self._analyze_sem = asyncio.Semaphore(concurrency)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._out = open(output, "a", encoding="utf-8")
+        self._pending_hashes: Set[str] = set()
+
+        self.counts: Dict[str, int] = {"ok": 0, "error": 0, "skipped_duplicate": 0}
+        self.preprocess_ms: Deque[int] = deque(maxlen=LATENCY_SAMPLES)
+        self.analysis_ms: Deque[int] = deque(maxlen=LATENCY_SAMPLES)
+
+    async def run(self, paths: Iterator[Path], done_paths: Set[str]) -> None:
+        tasks: Set[asyncio.Task] = set()
+        skipped_paths = 0
+        for path in paths:
+            key = str(path)
+            if key in done_paths:
+                skipped_paths += 1
+                continue
+            await self._in_flight.acquire()
+            task = asyncio.create_task(self._handle(key))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        self.counts["skipped_checkpoint"] = skipped_paths
+
+    async def _handle(self, path: str) -> None:
+        try:
+            try:
+                item = await self._process(path)
+            except Exception as exc:
+                # Anything unexpected (e.g. a worker process died) becomes an
+                # error line for this path instead of failing the gather in run().
+                item = {"path": path, "status": "error", "error_code": "INTERNAL_ERROR", "error": repr(exc)}
+            self._write(item)
+        finally:
+            self._in_flight.release()
+
+    async def _process(self, path: str) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        item = await loop.run_in_executor(self._pool, _preprocess, path)
+        if item["status"] != "preprocessed":
+            return item
+        self.preprocess_ms.append(item.pop("preprocess_ms"))
+        # Same bytes seen earlier in this run (finished or still in flight)
+        digest = item["sha256"]
+        if digest in self.done_hashes or digest in self._pending_hashes:
+            return {"path": path, "sha256": digest, "status": "skipped_duplicate"}
+        self._pending_hashes.add(digest)
+        try:
+            return await self._analyze(item)
+        finally:
+            self._pending_hashes.discard(digest)
+
+    async def _analyze(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        image_b64 = item.pop("image_b64")
+        record = {k: v for k, v in item.items() if k != "mime_type"}
+        async with self._analyze_sem:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    analysis, ms = await self.service.analyze(
+                        image_b64=image_b64,
+                        mime_type=item["mime_type"],
+                        image_dimensions=tuple(item["dimensions"]),
+                    )
+                except ValueError as exc:
+                    return {**record, "status": "error", "error_code": "AI_PARSE_ERROR", "error": str(exc)}
+                except Exception as exc:
+                    if is_quota_error(exc) and attempt < self.max_retries:
+                        await asyncio.sleep(min(60.0, 2.0 * 2 ** attempt))
+                        continue
+                    code = "UPSTREAM_QUOTA" if is_quota_error(exc) else "UPSTREAM_ERROR"
+                    return {**record, "status": "error", "error_code": code, "error": str(exc)}
+                break
+
+        self.analysis_ms.append(ms)
+        self.done_hashes.add(item["sha256"])
+        return {
+            **record,
+            "status": "ok",
+            "model": self.service.model_name,
+            "processing_ms": ms,
+            "analysis": analysis.model_dump(mode="json"),
+        }
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        status = record["status"]
+        self.counts[status] = self.counts.get(status, 0) + 1
+        self._out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._out.flush()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._out.close()
+
+
+def _percentile(values: Deque[int], pct: float) -> int:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _build_service(args: argparse.Namespace) -> GeminiNutritionService:
+    model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+    if args.replay_dir:
+        backend = ReplayBackend(
+            args.replay_dir,
+            model_name=model_name,
+            latency_ms=0,
+            strict=False,
+            config=REQUEST_CONFIG_DIGEST,
+        )
+        return GeminiNutritionService(backend=backend)
+    key_specs = parse_key_specs(os.getenv("GEMINI_API_KEYS", "")) or [
+        (os.getenv("GEMINI_API_KEY", ""), 1.0, None)
+    ]
+    pool = build_gemini_pool(
+        key_specs,
+        model_name=model_name,
+        strategy=os.getenv("GEMINI_POOL_STRATEGY", "least_loaded"),
+        rpm_limit=int(os.getenv("GEMINI_KEY_RPM", "0")) or None,
+        cooldown_s=float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", "30")),
+        # Enough SDK threads that --concurrency is never capped by the executor
+        threads_per_key=max(
+            int(os.getenv("GEMINI_THREADS_PER_KEY", "16")),
+            -(-args.concurrency // len(key_specs)),
+        ),
+    )
+    return GeminiNutritionService(backend=pool)
+
+
+def main(argv: List[str] | None = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("root", nargs="?", type=Path, help="Directory of images (walked recursively)")
+    source.add_argument("--manifest", type=Path, help="File with one path (or {\"path\": ...} JSON) per line")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="JSONL output / checkpoint")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Preprocessing processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent upstream calls")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="Images in memory at once (default 4 × concurrency)")
+    parser.add_argument("--max-retries", type=int, default=3, help="Retries for upstream quota errors")
+    parser.add_argument("--retry-errors", action="store_true", help="Re-run images that errored previously")
+    parser.add_argument("--max-size", type=int, default=int(os.getenv("MAX_IMAGE_SIZE_BYTES", str(10 * 1024 * 1024))))
+    parser.add_argument("--no-quality-gate", action="store_true")
+    parser.add_argument("--replay-dir", help="Serve analyses from cassettes instead of Gemini")
+    args = parser.parse_args(argv)
+
+    done_paths, done_hashes = load_checkpoint(args.output, args.retry_errors)
+    if done_paths:
+        print(f"Resuming: {len(done_paths)} paths already in {args.output}", file=sys.stderr)
+
+    runner = BulkRunner(
+        service=_build_service(args),
+        output=args.output,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        max_in_flight=args.max_in_flight or 4 * args.concurrency,
+        max_retries=args.max_retries,
+        done_hashes=done_hashes,
+        max_size=args.max_size,
+        quality=None if args.no_quality_gate else QualityThresholds(),
+    )
+
+    t0 = time.perf_counter()
+    try:
+        asyncio.run(runner.run(iter_inputs(args.root, args.manifest), done_paths))
+    except KeyboardInterrupt:
+        print("\nInterrupted — re-run the same command to resume.", file=sys.stderr)
+    finally:
+        runner.close()
+    elapsed = time.perf_counter() - t0
+
+    processed = runner.counts["ok"] + runner.counts["error"] + runner.counts["skipped_duplicate"]
+    summary = {
+        **runner.counts,
+        "elapsed_s": round(elapsed, 1),
+        "images_per_s": round(processed / elapsed, 2) if elapsed else 0.0,
+        "analyzed_per_s": round(runner.counts["ok"] / elapsed, 2) if elapsed else 0.0,
+        "preprocess_ms_p50": _percentile(runner.preprocess_ms, 0.50),
+        "preprocess_ms_p95": _percentile(runner.preprocess_ms, 0.95),
+        "analysis_ms_p50": _percentile(runner.analysis_ms, 0.50),
+        "analysis_ms_p95": _percentile(runner.analysis_ms, 0.95),
+    }
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    return 0 if runner.counts["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Calibrate / validate the image-quality gate against a labelled sample set.
+
+Expected layout (one sub-folder per label):
+
+    samples/
+    ├── good/          # photos Gemini analysed confidently
+    └── bad/           # photos that came back with low ai_confidence / retakes
+
+Every image is run through the same load → resize → assess pipeline as
+/analyze. The script prints per-label metric percentiles, the confusion matrix
+for the given thresholds, and gate latency.
+
+Run from the backend directory:
+  python -m scripts.calibrate_image_quality samples/ --blur-min-var 15
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from utils.image import (
+    QualityReport,
+    QualityThresholds,
+    assess_image_quality,
+    load_image,
+    resize_if_needed,
+)
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif"}
+METRICS = ("blur_variance", "mean_luminance", "clipped_fraction", "subject_fraction")
+
+
+def _assess_dir(folder: Path, thresholds: QualityThresholds) -> List[QualityReport]:
+    reports: List[QualityReport] = []
+    for path in sorted(folder.rglob("*")):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        try:
+            img = resize_if_needed(load_image(path.read_bytes()))
+        except Exception as exc:
+            print(f"  skip {path.name}: {exc}", file=sys.stderr)
+            continue
+        reports.append(assess_image_quality(img, thresholds))
+    return reports
+
+
+def _percentiles(values: List[float]) -> str:
+    p = np.percentile(values, [5, 25, 50, 75, 95])
+    return "  ".join(f"{v:9.2f}" for v in p)
+
+
+def main(argv: List[str] | None = None) -> int:
+    defaults = QualityThresholds()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("samples", type=Path, help="Directory with good/ and bad/ sub-folders")
+    parser.add_argument("--min-side-px", type=int, default=defaults.min_side_px)
+    parser.add_argument("--blur-min-var", type=float, default=defaults.blur_reject_var)
+    parser.add_argument("--dark-min-mean", type=float, default=defaults.dark_reject_mean)
+    parser.add_argument("--bright-max-mean", type=float, default=defaults.bright_reject_mean)
+    args = parser.parse_args(argv)
+
+    thresholds = QualityThresholds(
+        min_side_px=args.min_side_px,
+        blur_reject_var=args.blur_min_var,
+        dark_reject_mean=args.dark_min_mean,
+        bright_reject_mean=args.bright_max_mean,
+    )
+
+    by_label: Dict[str, List[QualityReport]] = {}
+    for label in ("good", "bad"):
+        folder = args.samples / label
+        if not folder.is_dir():
+            parser.error(f"missing sub-folder: {folder}")
+        by_label[label] = _assess_dir(folder, thresholds)
+        if not by_label[label]:
+            parser.error(f"no images found in {folder}")
+
+    print(f"{'metric':<18}{'label':<6}{'p5':>9}  {'p25':>9}  {'p50':>9}  {'p75':>9}  {'p95':>9}")
+    for metric in METRICS:
+        for label, reports in by_label.items():
+            values = [getattr(r, metric) for r in reports]
+            print(f"{metric:<18}{label:<6}{_percentiles(values)}")
+
+    good_rejected = sum(1 for r in by_label["good"] if r.rejection)
+    bad_rejected = sum(1 for r in by_label["bad"] if r.rejection)
+    n_good, n_bad = len(by_label["good"]), len(by_label["bad"])
+    print()
+    print(f"good: {n_good:5d}  rejected {good_rejected:5d}  (false reject rate {good_rejected / n_good:.1%})")
+    print(f"bad:  {n_bad:5d}  rejected {bad_rejected:5d}  (recall {bad_rejected / n_bad:.1%})")
+
+    codes: Dict[str, int] = {}
+    for r in by_label["good"] + by_label["bad"]:
+        if r.rejection:
+            codes[r.rejection] = codes.get(r.rejection, 0) + 1
+    for code, count in sorted(codes.items(), key=lambda kv: -kv[1]):
+        print(f"  {code:<22}{count:5d}")
+
+    timings = [r.elapsed_ms for rs in by_label.values() for r in rs]
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99])
+    print(f"\ngate latency: p50 {p50:.2f} ms  p95 {p95:.2f} ms  p99 {p99:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
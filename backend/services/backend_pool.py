@@ -0,0 +1,214 @@
+"""
+Multi-key / multi-project upstream pool.
+
+One API key caps throughput at one project's quota, and a single 429 storm
+takes the whole service down. BackendPool spreads calls over several
+VisionBackends (one per key / project) and is itself a VisionBackend, so the
+service and the record / replay wrappers don't know it exists.
+
+Routing:
+  - least_loaded          — fewest in-flight calls per unit of weight
+  - weighted_round_robin  — smooth WRR (nginx-style), ignoring load
+
+A member that returns a quota error is ejected for `cooldown_s` (doubling on
+repeated ejections, capped at `max_cooldown_s`) and the call is retried on the
+next member. Further 429s from calls already in flight when it was ejected
+belong to the same episode and do not extend the cooldown. The last available
+member is never ejected — its 429s fail only the requests that hit them, as a
+single key would. Members at their per-minute request limit are skipped. When no
+member is available the pool raises PoolExhaustedError, whose message carries
+"RESOURCE_EXHAUSTED" so the API maps it to 429 like a single-key quota error.
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+from services.vision_backend import BackendResponse, ContentParts, VisionBackend
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("least_loaded", "weighted_round_robin")
+
+
+class PoolExhaustedError(Exception):
+    """Every member is ejected or rate-limited."""
+
+
+def is_quota_error(exc: BaseException) -> bool:
+    """True for upstream 429 / RESOURCE_EXHAUSTED / quota errors."""
+    if getattr(exc, "code", None) == 429:
+        return True
+    text = str(exc).lower()
+    return "resource_exhausted" in text or "quota" in text
+
+
+# ─── Member ───────────────────────────────────────────────────────────────────
+
+
+@dataclass
+class PoolMember:
+    label: str
+    backend: VisionBackend
+    weight: float = 1.0
+    rpm_limit: Optional[int] = None
+
+    in_flight: int = 0
+    ejected_until: float = 0.0
+    ejections: int = 0
+    requests_total: int = 0
+    errors_total: int = 0
+    quota_errors_total: int = 0
+    _current_weight: float = 0.0
+    _recent: Deque[float] = field(default_factory=deque, repr=False)
+
+    def __post_init__(self) -> None:
+        # _pick divides by weight; zero, negative or NaN would break routing
+        if not 0 < self.weight < float("inf"):
+            raise ValueError(
+                f"Pool member {self.label!r} needs a positive weight, got {self.weight}."
+            )
+
+    def record_request(self, now: float) -> None:
+        # Trimmed here too, so the window stays bounded when nothing reads it
+        # (no rpm_limit and /health never polled).
+        self._recent.append(now)
+        self.requests_last_minute(now)
+
+    def requests_last_minute(self, now: float) -> int:
+        while self._recent and now - self._recent[0] > 60.0:
+            self._recent.popleft()
+        return len(self._recent)
+
+    def available(self, now: float) -> bool:
+        if now < self.ejected_until:
+            return False
+        if self.rpm_limit is not None and self.requests_last_minute(now) >= self.rpm_limit:
+            return False
+        return True
+
+
+# ─── Pool ─────────────────────────────────────────────────────────────────────
+
+
+class BackendPool:
+    """Load-balancing VisionBackend over several per-key backends."""
+
+    def __init__(
+        self,
+        members: List[PoolMember],
+        strategy: str = "least_loaded",
+        cooldown_s: float = 30.0,
+        max_cooldown_s: float = 300.0,
+    ) -> None:
+        if not members:
+            raise ValueError("BackendPool needs at least one member.")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown pool strategy {strategy!r}; expected one of {STRATEGIES}.")
+        self.members = members
+        self.strategy = strategy
+        self.cooldown_s = cooldown_s
+        self.max_cooldown_s = max_cooldown_s
+        self.model_name = members[0].backend.model_name
+
+    # ── VisionBackend ─────────────────────────────────────────────────────────
+
+    async def generate(self, parts: ContentParts) -> BackendResponse:
+        tried: set[str] = set()
+        last_exc: Optional[BaseException] = None
+
+        for _ in range(len(self.members)):
+            member = self._pick(exclude=tried)
+            if member is None:
+                break
+            tried.add(member.label)
+
+            member.in_flight += 1
+            member.requests_total += 1
+            member.record_request(time.monotonic())
+            try:
+                response = await member.backend.generate(parts)
+            except Exception as exc:
+                member.errors_total += 1
+                if not is_quota_error(exc) or not self._eject(member):
+                    raise
+                last_exc = exc
+                continue
+            finally:
+                member.in_flight -= 1
+
+            member.ejections = 0
+            return response
+
+        raise PoolExhaustedError(
+            "RESOURCE_EXHAUSTED: all upstream keys are cooling down or rate-limited."
+        ) from last_exc
+
+    # ── Health ────────────────────────────────────────────────────────────────
+
+    def health(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "label": m.label,
+                "weight": m.weight,
+                "available": m.available(now),
+                "ejected_for_s": max(0, round(m.ejected_until - now, 1)),
+                "in_flight": m.in_flight,
+                "requests_last_minute": m.requests_last_minute(now),
+                "rpm_limit": m.rpm_limit,
+                "requests_total": m.requests_total,
+                "errors_total": m.errors_total,
+                "quota_errors_total": m.quota_errors_total,
+            }
+            for m in self.members
+        ]
+
+    def available_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for m in self.members if m.available(now))
+
+    # ── Private helpers ───────────────────────────────────────────────────────
+
+    def _pick(self, exclude: set[str]) -> Optional[PoolMember]:
+        now = time.monotonic()
+        candidates = [
+            m for m in self.members if m.label not in exclude and m.available(now)
+        ]
+        if not candidates:
+            return None
+
+        if self.strategy == "least_loaded":
+            lowest = min(m.in_flight / m.weight for m in candidates)
+            candidates = [m for m in candidates if m.in_flight / m.weight == lowest]
+
+        # Smooth weighted round-robin among the remaining candidates
+        total = sum(m.weight for m in candidates)
+        for m in candidates:
+            m._current_weight += m.weight
+        chosen = max(candidates, key=lambda m: m._current_weight)
+        chosen._current_weight -= total
+        return chosen
+
+    def _eject(self, member: PoolMember) -> bool:
+        """
+        Take `member` out of rotation after a quota error. Returns False when
+        it is the last available member: it stays in, and the caller passes
+        the 429 through for this request only.
+        """
+        member.quota_errors_total += 1
+        if time.monotonic() < member.ejected_until:
+            return True  # Straggler from the burst that already ejected it
+        if self.available_count() <= 1:
+            return False  # Ejecting the last key would turn one 429 into minutes of 429s
+        cooldown = min(self.max_cooldown_s, self.cooldown_s * (2 ** member.ejections))
+        member.ejections += 1
+        member.ejected_until = time.monotonic() + cooldown
+        logger.warning(
+            "Upstream key %s hit quota — ejected for %.0f s", member.label, cooldown
+        )
+        return True
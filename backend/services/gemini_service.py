@@ -4,24 +4,47 @@ Gemini Vision service for the Cimas iGo AI nutrition analysis pipeline.
 Flow:
   1.  Receive base64-encoded image + MIME type from the image utility.
   2.  Build a structured multipart prompt (text instruction + inline image data).
-  3.  Call the Gemini API with temperature=0.2 for consistency.
+  3.  Call the vision backend (live Gemini at temperature=0.2 by default,
+      or a record / replay backend — see services/vision_backend.py).
   4.  Extract and clean the raw JSON from the model's text response.
   5.  Validate and return a NutritionAnalysis Pydantic model.
   6.  Derive any missing optional fields (verdict, ai_confidence, etc.).
+  7.  If strict parsing fails, repair instead of failing the request: close
+      truncated JSON, clamp out-of-range values, and — only if required
+      fields are still missing — ask for just those in a small follow-up call.
 """
 
 from __future__ import annotations
 
+import hashlib
 import json
 import logging
 import re
 import time
-from typing import Any, Dict, Optional, Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
+from google.api_core import client_options as client_options_lib
 from pydantic import ValidationError
 
 from models import NutritionAnalysis, GlycemicIndex, MealType, Verdict
+from services.backend_pool import BackendPool, PoolMember
+from services.prompt_cache import PromptCache, PromptCacheStats
+from services.response_repair import (
+    build_followup_contents,
+    clamp_to_schema,
+    followup_needs_image,
+    missing_required,
+    tolerant_parse,
+)
+from services.vision_backend import (
+    DEFAULT_UPSTREAM_THREADS,
+    GeminiBackend,
+    VisionBackend,
+    config_digest,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -79,31 +102,168 @@ VERDICT aligns with health_score:
 
 Always produce all fields. The JSON must be valid and parseable."""
 
+GENERATION_CONFIG: Dict[str, Any] = {
+    "temperature": 0.2,  # Low temp = more consistent nutrition data
+    "top_p": 0.85,
+    "max_output_tokens": 1024,
+    "response_mime_type": "text/plain",
+}
+
+# Part of every cassette fingerprint — see services/vision_backend.py
+REQUEST_CONFIG_DIGEST = config_digest(SYSTEM_PROMPT, GENERATION_CONFIG)
+
 # ─── Service Class ────────────────────────────────────────────────────────────
 
 
-class GeminiNutritionService:
+def build_gemini_backend(
+    api_key: str,
+    model_name: str = "gemini-1.5-flash",
+    endpoint: Optional[str] = None,
+    prompt_cache_ttl_s: Optional[float] = None,
+    cache_stats: Optional[PromptCacheStats] = None,
+    executor: Optional[Executor] = None,
+) -> GeminiBackend:
     """
-    Wraps the Google Gemini Vision API for meal nutrition analysis.
-    Thread-safe; designed to be used as a singleton per FastAPI app lifetime.
+    Return a live backend bound to SYSTEM_PROMPT.
+
+    Each backend gets its own API client (rather than the SDK's global
+    `genai.configure`) so several keys / projects can coexist in one process.
+    `endpoint` points the client at another host, e.g. a local stub
+    ("http://localhost:9100"); REST transport is used in that case.
+    `prompt_cache_ttl_s` enables an upstream cache of SYSTEM_PROMPT for this
+    key — call `backend.prompt_cache.ensure()` to create it. `executor` runs
+    the blocking SDK calls (a private 16-thread pool if omitted).
     """
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY is not set.")
+    generation_config = genai.types.GenerationConfig(**GENERATION_CONFIG)
+    client_kwargs: Dict[str, Any] = {
+        "client_options": client_options_lib.ClientOptions(
+            api_key=api_key, api_endpoint=endpoint
+        )
+    }
+    if endpoint:
+        client_kwargs["transport"] = "rest"
+    client = glm.GenerativeServiceClient(**client_kwargs)
+
+    model = genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=SYSTEM_PROMPT,
+        generation_config=generation_config,
+    )
+    model._client = client
+
+    prompt_cache: Optional[PromptCache] = None
+    if prompt_cache_ttl_s:
+
+        def build_cached_model(cache_name: str) -> Any:
+            # What GenerativeModel.from_cached_content does, minus its GET via
+            # the SDK's global client — the cache belongs to this key's project
+            cached = genai.GenerativeModel(
+                model_name=model_name, generation_config=generation_config
+            )
+            cached._cached_content = cache_name
+            cached._client = client
+            return cached
 
-    def __init__(self, api_key: str, model_name: str = "gemini-1.5-flash") -> None:
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY is not set.")
-        genai.configure(api_key=api_key)
-        self.model_name = model_name
-        self._model = genai.GenerativeModel(
+        prompt_cache = PromptCache(
+            glm.CacheServiceClient(**client_kwargs),
             model_name=model_name,
-            system_instruction=SYSTEM_PROMPT,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.2,           # Low temp = more consistent nutrition data
-                top_p=0.85,
-                max_output_tokens=1024,
-                response_mime_type="text/plain",
+            system_prompt=SYSTEM_PROMPT,
+            build_model=build_cached_model,
+            ttl_s=prompt_cache_ttl_s,
+        )
+    return GeminiBackend(
+        model, model_name, prompt_cache=prompt_cache, cache_stats=cache_stats, executor=executor
+    )
+
+
+def parse_key_specs(raw: str) -> List[Tuple[str, float, Optional[str]]]:
+    """
+    Parse GEMINI_API_KEYS: comma-separated `key[*weight][@endpoint]` entries,
+    e.g. "AIzaA*2,AIzaB,stub-key@http://localhost:9100".
+    Returns [(key, weight, endpoint_or_None), ...].
+    """
+    specs: List[Tuple[str, float, Optional[str]]] = []
+    for entry in raw.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        entry, _, endpoint = entry.partition("@")
+        key, _, weight = entry.partition("*")
+        value = float(weight) if weight else 1.0
+        if not 0 < value < float("inf"):
+            # Key itself left out of the message — it ends up in startup logs
+            raise ValueError(
+                f"GEMINI_API_KEYS entry #{len(specs) + 1} has weight {weight!r}; must be > 0."
+            )
+        specs.append((key.strip(), value, endpoint.strip() or None))
+    return specs
+
+
+def build_gemini_pool(
+    key_specs: List[Tuple[str, float, Optional[str]]],
+    model_name: str = "gemini-1.5-flash",
+    strategy: str = "least_loaded",
+    rpm_limit: Optional[int] = None,
+    cooldown_s: float = 30.0,
+    prompt_cache_ttl_s: Optional[float] = None,
+    cache_stats: Optional[PromptCacheStats] = None,
+    threads_per_key: int = DEFAULT_UPSTREAM_THREADS,
+) -> BackendPool:
+    """
+    One live backend per key, load-balanced by a BackendPool. All keys share
+    one thread pool sized `threads_per_key × keys`, so upstream concurrency
+    scales with the number of keys.
+    """
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, threads_per_key * len(key_specs)), thread_name_prefix="gemini"
+    )
+    members = [
+        PoolMember(
+            # Never expose the key itself — label by position + short hash
+            label=f"key-{i + 1}-{hashlib.sha256(key.encode()).hexdigest()[:8]}",
+            backend=build_gemini_backend(
+                key, model_name, endpoint, prompt_cache_ttl_s, cache_stats, executor
             ),
+            weight=weight,
+            rpm_limit=rpm_limit,
+        )
+        for i, (key, weight, endpoint) in enumerate(key_specs)
+    ]
+    return BackendPool(members, strategy=strategy, cooldown_s=cooldown_s)
+
+
+class GeminiNutritionService:
+    """
+    Meal nutrition analysis on top of a VisionBackend (live Gemini by default).
+    Thread-safe; designed to be used as a singleton per FastAPI app lifetime.
+    """
+
+    def __init__(
+        self,
+        api_key: str = "",
+        model_name: str = "gemini-1.5-flash",
+        backend: Optional[VisionBackend] = None,
+        repair_followup: bool = True,
+    ) -> None:
+        self.backend: VisionBackend = backend or build_gemini_backend(api_key, model_name)
+        self.model_name = self.backend.model_name
+        self.repair_followup = repair_followup
+        self._repair_counts: Dict[str, int] = {
+            "attempts": 0,
+            "repaired_locally": 0,
+            "repaired_with_followup": 0,
+            "failed": 0,
+            "followup_calls": 0,
+            "followup_text_calls": 0,
+            "followup_image_calls": 0,
+        }
+        logger.info(
+            "GeminiNutritionService initialised with model: %s (%s)",
+            self.model_name,
+            type(self.backend).__name__,
         )
-        logger.info("GeminiNutritionService initialised with model: %s", model_name)
 
     # ── Public method ─────────────────────────────────────────────────────────
 
@@ -124,9 +284,6 @@ class GeminiNutritionService:
         Returns:
             (NutritionAnalysis, processing_time_ms)
         """
-        import asyncio
-        import concurrent.futures
-
         user_prompt = self._build_user_prompt(image_dimensions)
 
         # Build multipart content for Gemini
@@ -136,26 +293,78 @@ class GeminiNutritionService:
         ]
 
         t_start = time.perf_counter()
-
-        # Gemini SDK is synchronous — run in thread pool to avoid blocking the event loop
-        loop = asyncio.get_running_loop()
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            response = await loop.run_in_executor(
-                pool,
-                lambda: self._model.generate_content(content_parts),
-            )
-
+        response = await self.backend.generate(content_parts)
         elapsed_ms = int((time.perf_counter() - t_start) * 1000)
         logger.info("Gemini responded in %d ms", elapsed_ms)
 
         raw_text = response.text
-        logger.debug("Raw Gemini response: %s", raw_text[:500])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw Gemini response: %s", raw_text[:500])
 
-        analysis = self._parse_and_validate(raw_text)
+        try:
+            analysis = self._parse_and_validate(raw_text)
+        except ValueError as exc:
+            logger.warning("Strict parse failed, attempting repair: %s", str(exc)[:200])
+            analysis = await self._repair(raw_text, content_parts)
+            elapsed_ms = int((time.perf_counter() - t_start) * 1000)
         return analysis, elapsed_ms
 
+    def repair_stats(self) -> Dict[str, Any]:
+        """Repair-stage counters for /metrics."""
+        counts = dict(self._repair_counts)
+        repaired = counts["repaired_locally"] + counts["repaired_with_followup"]
+        counts["success_rate"] = round(repaired / counts["attempts"], 3) if counts["attempts"] else None
+        # Each repair avoids a 422 → user re-upload → second full vision call,
+        # but a follow-up that replays the image is itself a vision call.
+        counts["vision_calls_saved"] = repaired - counts["followup_image_calls"]
+        return counts
+
     # ── Private helpers ───────────────────────────────────────────────────────
 
+    async def _repair(self, raw_text: str, content_parts: List[Any]) -> NutritionAnalysis:
+        """
+        Salvage a response that failed `_parse_and_validate`. Raises ValueError
+        (→ AI_PARSE_ERROR) only when even the follow-up cannot complete it.
+        """
+        self._repair_counts["attempts"] += 1
+        partial = clamp_to_schema(self._normalise_keys(tolerant_parse(raw_text) or {}))
+        missing = missing_required(partial)
+        used_followup = False
+
+        if missing and self.repair_followup:
+            used_followup = True
+            self._repair_counts["followup_calls"] += 1
+            kind = "followup_image_calls" if followup_needs_image(partial) else "followup_text_calls"
+            self._repair_counts[kind] += 1
+            contents = build_followup_contents(content_parts, raw_text, partial, missing)
+            try:
+                followup = await self.backend.generate(contents)
+                extra = tolerant_parse(followup.text) or {}
+            except Exception as exc:
+                logger.warning("Repair follow-up call failed: %s", exc)
+                extra = {}
+            filled = clamp_to_schema(self._normalise_keys(extra))
+            partial.update({k: v for k, v in filled.items() if k in missing})
+            missing = missing_required(partial)
+
+        if missing:
+            self._repair_counts["failed"] += 1
+            raise ValueError(
+                f"AI response incomplete after repair; missing fields: {', '.join(missing)}"
+            )
+
+        self._fill_defaults(partial)
+        try:
+            analysis = NutritionAnalysis(**partial)
+        except ValidationError as exc:
+            self._repair_counts["failed"] += 1
+            raise ValueError(f"AI response failed validation after repair: {exc}") from exc
+
+        key = "repaired_with_followup" if used_followup else "repaired_locally"
+        self._repair_counts[key] += 1
+        logger.info("Gemini response repaired (%s)", key)
+        return analysis
+
     def _build_user_prompt(self, dimensions: Optional[Tuple[int, int]]) -> str:
         dim_hint = ""
         if dimensions:
@@ -180,7 +389,11 @@ class GeminiNutritionService:
         try:
             raw_dict: Dict[str, Any] = json.loads(json_str)
         except json.JSONDecodeError as exc:
-            logger.error("JSON decode failed. Raw text: %s", raw_text[:1000])
+            # Raw model text is only captured at DEBUG — it is large and may be noisy
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.error("JSON decode failed. Raw text: %s", raw_text[:1000])
+            else:
+                logger.error("JSON decode failed (%d chars of model text)", len(raw_text))
             raise ValueError(
                 f"Gemini returned malformed JSON. Parse error: {exc}"
             ) from exc
@@ -188,6 +401,15 @@ class GeminiNutritionService:
         # Normalise common Gemini naming variations
         raw_dict = self._normalise_keys(raw_dict)
 
+        self._fill_defaults(raw_dict)
+
+        try:
+            return NutritionAnalysis(**raw_dict)
+        except ValidationError as exc:
+            logger.error("Pydantic validation failed: %s", exc)
+            raise ValueError(f"AI response failed validation: {exc}") from exc
+
+    def _fill_defaults(self, raw_dict: Dict[str, Any]) -> None:
         # Derive verdict from health_score if Gemini omitted it
         if "verdict" not in raw_dict or raw_dict.get("verdict") is None:
             raw_dict["verdict"] = self._score_to_verdict(raw_dict.get("health_score", 50))
@@ -196,12 +418,6 @@ class GeminiNutritionService:
         if "ai_confidence" not in raw_dict or raw_dict.get("ai_confidence") is None:
             raw_dict["ai_confidence"] = 85
 
-        try:
-            return NutritionAnalysis(**raw_dict)
-        except ValidationError as exc:
-            logger.error("Pydantic validation failed: %s", exc)
-            raise ValueError(f"AI response failed validation: {exc}") from exc
-
     @staticmethod
     def _extract_json(text: str) -> str:
         """
@@ -0,0 +1,269 @@
+"""
+Upstream prompt-prefix caching for the static system instruction.
+
+SYSTEM_PROMPT (role, rules, JSON schema, scoring guide) is identical on every
+call, yet without caching it is sent and prefilled as input tokens each time.
+Gemini's CachedContent stores that prefix server-side; requests then name the
+cache instead of carrying the instruction and pay the cheaper cached-token rate.
+
+  - PromptCache       — one CachedContent per key / project (caches are not
+                        shared across projects). Created at startup, TTL
+                        extended by a background task, re-created on demand.
+  - PromptCacheStats  — accounting hook: input tokens and latency per call,
+                        split by cached vs uncached prefix, for /metrics.
+
+Any cache failure falls back to the plain request with the inline system
+instruction, so caching can only make a call cheaper, never fail it.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import google.ai.generativelanguage as glm
+
+logger = logging.getLogger(__name__)
+
+# Treat a cache as gone this long before its TTL so in-flight calls never race expiry
+_EXPIRY_SLACK_S = 30.0
+# Shorter TTLs put each half-life refresh inside the slack window, so the cache
+# would be re-created every tick and unused for half of each cycle
+MIN_TTL_S = 10 * _EXPIRY_SLACK_S
+
+
+def is_cache_miss_error(exc: BaseException) -> bool:
+    """True when the upstream rejected a request because its cache is gone."""
+    if getattr(exc, "code", None) == 404:
+        return True
+    text = str(exc).lower()
+    return "cachedcontent" in text.replace(" ", "") and (
+        "not found" in text or "expired" in text or "permission" in text
+    )
+
+
+# ─── Cache ────────────────────────────────────────────────────────────────────
+
+
+class PromptCache:
+    """
+    One upstream CachedContent holding the system instruction.
+
+    Args:
+        client:         glm.CacheServiceClient for the owning key / project.
+        model_name:     Model the cache is created for (must match the calls).
+        system_prompt:  The static prefix to cache.
+        build_model:    cache name → GenerativeModel bound to that cache.
+        ttl_s:          Upstream TTL set on create and on every refresh
+                        (raised to MIN_TTL_S if lower).
+        retry_s:        After a failed create, stay on the uncached path this long.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        model_name: str,
+        system_prompt: str,
+        build_model: Callable[[str], Any],
+        ttl_s: float = 3600.0,
+        retry_s: float = 300.0,
+    ) -> None:
+        self._client = client
+        self.model_name = model_name
+        self._system_prompt = system_prompt
+        self._build_model = build_model
+        if ttl_s < MIN_TTL_S:
+            logger.warning(
+                "Prompt cache TTL %.0f s is below the %.0f s minimum — using %.0f s",
+                ttl_s,
+                MIN_TTL_S,
+                MIN_TTL_S,
+            )
+        self.ttl_s = max(ttl_s, MIN_TTL_S)
+        self.retry_s = retry_s
+
+        self._lock = threading.Lock()
+        self._name: Optional[str] = None
+        self._model: Any = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self.creates_total = 0
+        self.refreshes_total = 0
+        self.errors_total = 0
+        self.last_error: Optional[str] = None
+
+    # ── Request path (no I/O) ─────────────────────────────────────────────────
+
+    def model(self) -> Any:
+        """The cache-bound model, or None if the cache is missing / near expiry."""
+        if self._name is None or time.monotonic() >= self._expires_at - _EXPIRY_SLACK_S:
+            return None
+        return self._model
+
+    def invalidate(self) -> None:
+        """
+        Forget the cache after the upstream reported it gone, and re-create it
+        in the background rather than waiting for the next refresher tick.
+        """
+        with self._lock:
+            was_live = self._name is not None
+            if was_live:
+                logger.warning("Prompt cache %s is gone upstream — falling back", self._name)
+            self._name = None
+            self._model = None
+        if was_live:
+            # Only the first caller of a burst of 404s schedules the re-create
+            self._schedule_ensure()
+
+    def _schedule_ensure(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            threading.Thread(target=self.ensure, name="prompt-cache", daemon=True).start()
+            return
+        loop.run_in_executor(None, self.ensure)
+
+    # ── Maintenance (blocking — run in an executor) ───────────────────────────
+
+    def ensure(self) -> Optional[str]:
+        """Extend the live cache's TTL, or create one. Returns the cache name."""
+        with self._lock:
+            now = time.monotonic()
+            if self._name is None and now < self._retry_at:
+                return None
+            if self._name is not None and now < self._expires_at - _EXPIRY_SLACK_S:
+                try:
+                    self._client.update_cached_content(
+                        cached_content=glm.CachedContent(
+                            name=self._name, ttl=timedelta(seconds=self.ttl_s)
+                        ),
+                        update_mask={"paths": ["ttl"]},
+                    )
+                    self._expires_at = time.monotonic() + self.ttl_s
+                    self.refreshes_total += 1
+                    return self._name
+                except Exception as exc:
+                    logger.warning("Prompt cache refresh failed (%s) — re-creating", exc)
+            if self._name is not None:
+                # Don't leave the old cache billing storage until its TTL runs out
+                self._delete_quietly(self._name)
+            self._create()
+            return self._name
+
+    def delete(self) -> None:
+        """Best-effort cleanup at shutdown so unused caches stop accruing storage."""
+        with self._lock:
+            name, self._name, self._model = self._name, None, None
+        if name is not None:
+            self._delete_quietly(name)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "active": self.model() is not None,
+            "expires_in_s": max(0, round(self._expires_at - time.monotonic())) if self._name else 0,
+            "creates_total": self.creates_total,
+            "refreshes_total": self.refreshes_total,
+            "errors_total": self.errors_total,
+            "last_error": self.last_error,
+        }
+
+    def _delete_quietly(self, name: str) -> None:
+        try:
+            self._client.delete_cached_content(name=name)
+        except Exception as exc:
+            logger.debug("Prompt cache delete failed: %s", exc)
+
+    def _create(self) -> None:
+        self._name = None
+        self._model = None
+        try:
+            created = self._client.create_cached_content(
+                cached_content=glm.CachedContent(
+                    model=_qualified(self.model_name),
+                    system_instruction=glm.Content(parts=[glm.Part(text=self._system_prompt)]),
+                    ttl=timedelta(seconds=self.ttl_s),
+                )
+            )
+        except Exception as exc:
+            # e.g. prefix below the model's minimum cacheable size, or no caching
+            # on this model version — stay uncached and try again later
+            self.errors_total += 1
+            self.last_error = str(exc)[:200]
+            self._retry_at = time.monotonic() + self.retry_s
+            logger.warning("Prompt cache create failed — using uncached prompt: %s", exc)
+            return
+        self._name = created.name
+        self._model = self._build_model(created.name)
+        self._expires_at = time.monotonic() + self.ttl_s
+        self.creates_total += 1
+        self.last_error = None
+        logger.info("Prompt cache created: %s (ttl %.0f s)", created.name, self.ttl_s)
+
+
+def _qualified(model_name: str) -> str:
+    return model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+
+async def keep_prompt_caches_warm(caches: List[PromptCache], interval_s: float) -> None:
+    """Background task: refresh (or re-create) every cache each `interval_s`."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_s)
+        await asyncio.gather(
+            *(loop.run_in_executor(None, cache.ensure) for cache in caches),
+            return_exceptions=True,
+        )
+
+
+# ─── Accounting ───────────────────────────────────────────────────────────────
+
+
+class PromptCacheStats:
+    """
+    Per-call accounting, split by whether the cached prefix was used.
+
+    `record` is the hook GeminiBackend calls after every upstream response.
+    `prompt_token_count` includes cached tokens; billable input is the rest.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, float]] = {
+            mode: {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "latency_ms": 0.0}
+            for mode in ("cached", "uncached")
+        }
+        self.fallbacks_total = 0
+
+    def record(self, cached: bool, usage: Dict[str, int], latency_ms: float) -> None:
+        with self._lock:
+            bucket = self._buckets["cached" if cached else "uncached"]
+            bucket["calls"] += 1
+            bucket["prompt_tokens"] += usage.get("prompt_token_count", 0)
+            bucket["cached_tokens"] += usage.get("cached_content_token_count", 0)
+            bucket["latency_ms"] += latency_ms
+
+    def record_fallback(self) -> None:
+        with self._lock:
+            self.fallbacks_total += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            report: Dict[str, Any] = {"fallbacks_total": self.fallbacks_total}
+            for mode, b in self._buckets.items():
+                calls = int(b["calls"])
+                report[mode] = {
+                    "calls": calls,
+                    "avg_prompt_tokens": round(b["prompt_tokens"] / calls, 1) if calls else None,
+                    "avg_cached_tokens": round(b["cached_tokens"] / calls, 1) if calls else None,
+                    "avg_billable_input_tokens": (
+                        round((b["prompt_tokens"] - b["cached_tokens"]) / calls, 1)
+                        if calls
+                        else None
+                    ),
+                    "avg_latency_ms": round(b["latency_ms"] / calls, 1) if calls else None,
+                }
+        return report
@@ -0,0 +1,233 @@
+"""
+Repair helpers for Gemini responses that fail strict parsing or validation.
+
+A response truncated at max_output_tokens, or with one value out of range,
+used to cost the user a re-upload and us a second full vision call. These
+helpers salvage what is there:
+
+  - tolerant_parse     — close truncated JSON, dropping only the field that
+                         was cut off mid-value
+  - clamp_to_schema    — coerce / clamp values into NutritionAnalysis bounds;
+                         drop optional fields that cannot be fixed
+  - missing_required   — required fields still absent after the above
+  - build_followup_*   — a small follow-up request for just those fields
+
+All functions are pure; GeminiNutritionService orchestrates them.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from enum import Enum
+from typing import Any, Dict, List, Optional, get_args
+
+from models import NutritionAnalysis
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+_FENCE_RE = re.compile(r"```(?:json)?\s*", flags=re.IGNORECASE)
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+# ─── Tolerant JSON ────────────────────────────────────────────────────────────
+
+
+def tolerant_parse(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Parse the first JSON object in `text`, closing it if truncated.
+
+    Tries, in order:
+      1. the text up to the end of the last complete value, with any open
+         objects / arrays closed
+      2. the text cut back to each earlier top-level-or-nested comma, closed
+
+    Returns the parsed dict, or None if nothing parseable remains.
+    """
+    text = _FENCE_RE.sub("", text).replace("```", "")
+    start = text.find("{")
+    if start < 0:
+        return None
+    text = text[start:]
+
+    stack: List[str] = []
+    in_string = False
+    escaped = False
+    # (index, closers) pairs — cut points just before a comma
+    comma_cuts: List[tuple[int, str]] = []
+
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                # Complete object — ignore any trailing chatter
+                return _loads_dict(text[: i + 1])
+        elif ch == ",":
+            comma_cuts.append((i, "".join(reversed(stack))))
+
+    # Truncated: first try keeping everything if it ends on a finished value
+    tail = text.rstrip()
+    if not in_string and tail and tail[-1] in '"}]':
+        parsed = _loads_dict(tail + "".join(reversed(stack)))
+        if parsed is not None:
+            return parsed
+
+    for index, closers in reversed(comma_cuts):
+        parsed = _loads_dict(text[:index] + closers)
+        if parsed is not None:
+            return parsed
+    return None
+
+
+def _loads_dict(candidate: str) -> Optional[Dict[str, Any]]:
+    try:
+        value = json.loads(candidate)
+    except json.JSONDecodeError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+# ─── Schema clamping ──────────────────────────────────────────────────────────
+
+
+def _constraints(field_info: Any) -> Dict[str, Any]:
+    found: Dict[str, Any] = {}
+    for meta in field_info.metadata:
+        for attr in ("ge", "le", "min_length", "max_length"):
+            value = getattr(meta, attr, None)
+            if value is not None:
+                found[attr] = value
+    return found
+
+
+def _base_type(annotation: Any) -> Any:
+    """Optional[X] → X; List[str] stays List[str]."""
+    args = [a for a in get_args(annotation) if a is not type(None)]
+    if args and getattr(annotation, "__origin__", None) is not list:
+        return args[0]
+    return annotation
+
+
+def _coerce_number(value: Any, as_int: bool) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str):
+        match = _NUMBER_RE.search(value.replace(",", ""))
+        if not match:
+            return None
+        number = float(match.group(0))
+    else:
+        return None
+    return round(number) if as_int else number
+
+
+def clamp_to_schema(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of `data` with every NutritionAnalysis field coerced into
+    its declared type and bounds. Unknown keys are dropped; values that cannot
+    be coerced are removed (so required ones show up in `missing_required`).
+    """
+    fixed: Dict[str, Any] = {}
+    for name, info in NutritionAnalysis.model_fields.items():
+        if data.get(name) is None:
+            continue
+        value = data[name]
+        limits = _constraints(info)
+        base = _base_type(info.annotation)
+
+        if base in (int, float):
+            number = _coerce_number(value, as_int=base is int)
+            if number is None:
+                continue
+            if "ge" in limits:
+                number = max(limits["ge"], number)
+            if "le" in limits:
+                number = min(limits["le"], number)
+            fixed[name] = int(number) if base is int else number
+
+        elif base is str:
+            text = str(value).strip()
+            if "max_length" in limits:
+                text = text[: limits["max_length"]].rstrip()
+            if len(text) < limits.get("min_length", 0):
+                continue
+            fixed[name] = text
+
+        elif isinstance(base, type) and issubclass(base, Enum):
+            wanted = str(value).strip().lower()
+            match = next((m for m in base if m.value.lower() == wanted), None)
+            if match is not None:
+                fixed[name] = match.value
+
+        elif getattr(base, "__origin__", None) is list:
+            if not isinstance(value, list):
+                continue
+            items = [str(v).strip() for v in value if str(v).strip()]
+            fixed[name] = items[: limits.get("max_length", len(items))]
+
+        else:
+            fixed[name] = value
+    return fixed
+
+
+def missing_required(data: Dict[str, Any]) -> List[str]:
+    return [
+        name
+        for name, info in NutritionAnalysis.model_fields.items()
+        if info.is_required() and data.get(name) is None
+    ]
+
+
+# ─── Follow-up request ────────────────────────────────────────────────────────
+
+
+def build_followup_prompt(partial: Dict[str, Any], missing: List[str]) -> str:
+    return (
+        "Your previous answer was incomplete. Here is what was received:\n"
+        f"{json.dumps(partial, ensure_ascii=False)}\n\n"
+        f"Return ONLY a raw JSON object with exactly these keys: {', '.join(missing)}. "
+        "Follow the same schema and rules as before, stay consistent with the "
+        "values above, and keep it short."
+    )
+
+
+def followup_needs_image(partial: Dict[str, Any]) -> bool:
+    """True when the follow-up has to replay the image (meal not identified)."""
+    return not partial.get("meal_name")
+
+
+def build_followup_contents(
+    original_parts: List[Any],
+    raw_text: str,
+    partial: Dict[str, Any],
+    missing: List[str],
+) -> List[Any]:
+    """
+    Contents for the follow-up call.
+
+    When the meal was already identified, the partial JSON is enough context
+    and the call is text-only. Otherwise the first exchange (including the
+    image) is replayed as conversation history so the model can finish it.
+    """
+    prompt = build_followup_prompt(partial, missing)
+    if not followup_needs_image(partial):
+        return [prompt]
+    return [
+        {"role": "user", "parts": original_parts},
+        {"role": "model", "parts": [raw_text]},
+        {"role": "user", "parts": [prompt]},
+    ]
@@ -0,0 +1,78 @@
+"""
+Content-addressed store of completed analyses.
+
+Results are keyed by the SHA-256 of the raw uploaded image bytes, so a client
+that already knows the hash of its photo can ask for the result before
+uploading anything (GET/HEAD /analysis/{sha256}, or X-Image-SHA256 on
+/analyze), and a re-upload of identical bytes skips the Gemini call.
+
+In-process LRU with TTL — one store per worker. Values are the serialised
+AnalyzeResponse dicts, so entries can be returned without re-validation.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalise_hash(value: str) -> Optional[str]:
+    """
+    Accept a bare hex digest, an ETag-style quoted value (optionally weak, W/"…")
+    or a "sha256:"-prefixed digest. Returns the lowercase digest or None.
+    """
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    value = value.strip('"').lower()
+    if value.startswith("sha256:"):
+        value = value[len("sha256:"):]
+    return value if SHA256_RE.match(value) else None
+
+
+class ResultStore:
+    """Bounded LRU of sha256 → serialised AnalyzeResponse, with expiry."""
+
+    def __init__(self, max_entries: int = 10_000, ttl_s: float = 7 * 24 * 3600) -> None:
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, payload = entry
+        if time.monotonic() - stored_at > self.ttl_s:
+            del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return payload
+
+    def put(self, digest: str, payload: Dict[str, Any]) -> None:
+        self._entries[digest] = (time.monotonic(), payload)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
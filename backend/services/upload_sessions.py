@@ -0,0 +1,282 @@
+"""
+Resumable chunked uploads for unreliable mobile networks.
+
+Protocol (tus-like, offsets in bytes):
+  1.  POST  /uploads                 {size, sha256?, filename?} → upload_id
+  2.  PATCH /uploads/{id}            Upload-Offset: <n>, body = chunk bytes
+      HEAD  /uploads/{id}            → Upload-Offset: <bytes received so far>
+  3.  POST  /uploads/{id}/finalize   → AnalyzeResponse
+
+After a dropped connection the client asks for the current offset and resends
+only the missing tail. Chunks are spooled to one temp file per session. Disk
+use is bounded by reserving each session's declared size up front, and idle
+sessions expire after `ttl_s`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ─── Errors ───────────────────────────────────────────────────────────────────
+
+
+class UploadSessionNotFound(KeyError):
+    """Unknown or expired upload_id."""
+
+
+class UploadOffsetMismatch(ValueError):
+    """PATCH offset is ahead of the bytes received so far."""
+
+    def __init__(self, expected: int, got: int) -> None:
+        super().__init__(f"Upload-Offset {got} does not match received bytes {expected}.")
+        self.expected = expected
+        self.got = got
+
+
+class UploadStorageFull(Exception):
+    """Spool directory has no room for another session of this size."""
+
+
+# ─── Session ──────────────────────────────────────────────────────────────────
+
+
+@dataclass
+class UploadSession:
+    upload_id: str
+    size: int
+    path: Path
+    filename: Optional[str] = None
+    sha256: Optional[str] = None
+    offset: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+    touched_at: float = field(default_factory=time.monotonic)
+    completed_digest: Optional[str] = None
+    resume_pending: bool = False
+    released: bool = False
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+    # In-flight finalize; concurrent / retried finalize calls await this one
+    finalize_task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def complete(self) -> bool:
+        return self.offset >= self.size
+
+
+# ─── Manager ──────────────────────────────────────────────────────────────────
+
+
+class UploadSessionManager:
+    """
+    Owns the spool directory and all live sessions for this worker.
+
+    Args:
+        spool_dir:         Directory for chunk files (a temp dir if None). Created
+                           on the first upload, not at construction, so importing
+                           the app leaves nothing behind.
+        max_session_bytes: Largest declared size accepted (MAX_IMAGE_SIZE_BYTES).
+        max_total_bytes:   Sum of declared sizes allowed on disk at once.
+        ttl_s:             Idle sessions older than this are deleted.
+    """
+
+    def __init__(
+        self,
+        spool_dir: Optional[str] = None,
+        max_session_bytes: int = 10 * 1024 * 1024,
+        max_total_bytes: int = 512 * 1024 * 1024,
+        ttl_s: float = 3600,
+    ) -> None:
+        self._configured_dir = Path(spool_dir) if spool_dir else None
+        self._spool_dir: Optional[Path] = None
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl_s = ttl_s
+
+        self._sessions: Dict[str, UploadSession] = {}
+        self._reserved_bytes = 0
+
+        self.created_total = 0
+        self.completed_total = 0
+        self.expired_total = 0
+        self.resumes_total = 0
+        self.bytes_received = 0
+        self.bytes_saved_by_resume = 0
+        self.duplicate_bytes_discarded = 0
+
+    @property
+    def spool_dir(self) -> Path:
+        if self._spool_dir is None:
+            if self._configured_dir is None:
+                self._spool_dir = Path(tempfile.mkdtemp(prefix="igo-uploads-"))
+            else:
+                self._configured_dir.mkdir(parents=True, exist_ok=True)
+                self._spool_dir = self._configured_dir
+        return self._spool_dir
+
+    # ── Lifecycle ─────────────────────────────────────────────────────────────
+
+    def create(
+        self, size: int, filename: Optional[str] = None, sha256: Optional[str] = None
+    ) -> UploadSession:
+        if size <= 0:
+            raise ValueError("Upload size must be positive.")
+        if size > self.max_session_bytes:
+            mb = self.max_session_bytes / 1_048_576
+            raise ValueError(f"Image exceeds the maximum allowed size of {mb:.0f} MB.")
+
+        self.sweep_expired()
+        if self._reserved_bytes + size > self.max_total_bytes:
+            raise UploadStorageFull("Upload storage is full. Please try again shortly.")
+
+        upload_id = secrets.token_urlsafe(16)
+        path = self.spool_dir / f"{upload_id}.part"
+        path.touch()
+        session = UploadSession(
+            upload_id=upload_id, size=size, path=path, filename=filename, sha256=sha256
+        )
+        self._sessions[upload_id] = session
+        self._reserved_bytes += size
+        self.created_total += 1
+        return session
+
+    def get(self, upload_id: str, resuming: bool = False) -> UploadSession:
+        """
+        Look up a live session. `resuming=True` marks an offset query from a
+        client picking up after a drop; the resume is counted by the next
+        PATCH, so repeated or polling queries do not inflate the metrics.
+        """
+        session = self._sessions.get(upload_id)
+        if session is None or self._expired(session):
+            if session is not None:
+                self._discard(session)
+                self.expired_total += 1
+            raise UploadSessionNotFound(upload_id)
+        session.touched_at = time.monotonic()
+        if resuming and 0 < session.offset < session.size:
+            session.resume_pending = True
+        return session
+
+    async def append(self, upload_id: str, offset: int, chunk: bytes) -> UploadSession:
+        """
+        Write `chunk` at `offset`. A chunk that overlaps bytes already received
+        (client resent after a lost ACK) is trimmed; a gap is rejected.
+        """
+        session = self.get(upload_id)
+        async with session.lock:
+            if offset > session.offset:
+                raise UploadOffsetMismatch(session.offset, offset)
+            if session.resume_pending:
+                # First chunk after an offset query: the client skipped `offset`
+                # bytes it would otherwise have resent (0 = started over).
+                session.resume_pending = False
+                if offset > 0:
+                    self.resumes_total += 1
+                    self.bytes_saved_by_resume += offset
+            overlap = session.offset - offset
+            if overlap:
+                self.duplicate_bytes_discarded += min(overlap, len(chunk))
+                chunk = chunk[overlap:]
+            if session.offset + len(chunk) > session.size:
+                raise ValueError("Chunk extends past the declared upload size.")
+            if chunk:
+                await asyncio.to_thread(_write_at, session.path, session.offset, chunk)
+                session.offset += len(chunk)
+                self.bytes_received += len(chunk)
+            session.touched_at = time.monotonic()
+        return session
+
+    async def read_complete(self, upload_id: str) -> bytes:
+        """Return the assembled bytes; verifies completeness and the declared hash."""
+        session = self.get(upload_id)
+        async with session.lock:
+            if not session.complete:
+                raise ValueError(
+                    f"Upload incomplete: {session.offset} of {session.size} bytes received."
+                )
+            data = await asyncio.to_thread(session.path.read_bytes)
+            if session.sha256 and hashlib.sha256(data).hexdigest() != session.sha256:
+                raise ValueError("Assembled upload does not match the declared sha256.")
+            return data
+
+    def mark_done(self, upload_id: str, digest: str) -> None:
+        """
+        Free the spool file but keep the session record (until expiry) so a
+        retried finalize can be answered from the result store.
+        """
+        session = self._sessions.get(upload_id)
+        if session is None or session.completed_digest:
+            return
+        session.completed_digest = digest
+        self._release_file(session)
+        self.completed_total += 1
+
+    def discard(self, upload_id: str) -> None:
+        """Drop a session and its spool file (e.g. the image was rejected)."""
+        session = self._sessions.get(upload_id)
+        if session is not None:
+            self._discard(session)
+
+    def sweep_expired(self) -> int:
+        expired = [s for s in self._sessions.values() if self._expired(s)]
+        for session in expired:
+            self._discard(session)
+        self.expired_total += len(expired)
+        return len(expired)
+
+    def close(self) -> None:
+        for session in list(self._sessions.values()):
+            self._discard(session)
+        if self._spool_dir is not None and self._configured_dir is None:
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+        self._spool_dir = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "active_sessions": sum(1 for s in self._sessions.values() if not s.completed_digest),
+            "reserved_disk_bytes": self._reserved_bytes,
+            "max_disk_bytes": self.max_total_bytes,
+            "created_total": self.created_total,
+            "completed_total": self.completed_total,
+            "expired_total": self.expired_total,
+            "resumes_total": self.resumes_total,
+            "bytes_received": self.bytes_received,
+            "bytes_saved_by_resume": self.bytes_saved_by_resume,
+            "duplicate_bytes_discarded": self.duplicate_bytes_discarded,
+        }
+
+    # ── Private helpers ───────────────────────────────────────────────────────
+
+    def _expired(self, session: UploadSession) -> bool:
+        return time.monotonic() - session.touched_at > self.ttl_s
+
+    def _release_file(self, session: UploadSession) -> None:
+        if session.released:
+            return
+        try:
+            os.unlink(session.path)
+        except FileNotFoundError:
+            pass
+        self._reserved_bytes -= session.size
+        session.released = True
+
+    def _discard(self, session: UploadSession) -> None:
+        self._sessions.pop(session.upload_id, None)
+        self._release_file(session)
+
+
+def _write_at(path: Path, offset: int, chunk: bytes) -> None:
+    with open(path, "r+b") as fh:
+        fh.seek(offset)
+        fh.write(chunk)
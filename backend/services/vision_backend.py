@@ -0,0 +1,313 @@
+"""
+Pluggable vision backends for GeminiNutritionService.
+
+The service builds the prompt and parses the reply; a backend only turns a
+list of content parts into raw model text. That seam lets us swap the live
+Gemini API for a recorder or a replayer:
+
+  - GeminiBackend     — live google-generativeai call (the default), optionally
+                        through an upstream prompt cache (services/prompt_cache.py)
+  - RecordingBackend  — wraps another backend, writes every exchange to a
+                        cassette directory keyed by a request fingerprint
+  - ReplayBackend     — serves cassettes back with their original (or a
+                        configured) latency; no network, no API key
+
+Content parts use the Gemini SDK shape: plain strings for text and
+{"mime_type": ..., "data": <base64 str>} dicts for inline images, or a list of
+{"role": ..., "parts": [...]} turns for multi-turn requests.
+
+A cassette is one JSON file per fingerprint:
+    {"fingerprint", "model", "config", "parts", "text", "usage", "latency_ms", "recorded_at"}
+where image parts are stored as their SHA-256 only. The fingerprint also
+covers a digest of the system instruction and generation config ("config"),
+so a prompt or temperature change makes strict replay miss instead of
+serving stale answers.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Protocol
+
+from services.prompt_cache import PromptCache, PromptCacheStats, is_cache_miss_error
+
+logger = logging.getLogger(__name__)
+
+ContentParts = List[Any]
+
+# Blocking SDK calls per backend when no shared executor is passed in. Each
+# in-flight upstream call occupies a thread for its whole latency.
+DEFAULT_UPSTREAM_THREADS = 16
+
+
+# ─── Interface ────────────────────────────────────────────────────────────────
+
+
+@dataclass
+class BackendResponse:
+    """Raw model output plus whatever usage metadata the backend exposes."""
+
+    text: str
+    usage: Dict[str, int] = field(default_factory=dict)
+
+
+class VisionBackend(Protocol):
+    """Anything that can turn Gemini-style content parts into model text."""
+
+    model_name: str
+
+    async def generate(self, parts: ContentParts) -> BackendResponse:
+        ...
+
+
+class CassetteMissError(LookupError):
+    """Raised by ReplayBackend when no cassette matches a request."""
+
+
+# ─── Fingerprinting ───────────────────────────────────────────────────────────
+
+
+def _canonical_parts(parts: ContentParts) -> List[Any]:
+    """Replace inline image payloads with their SHA-256 so cassettes stay small."""
+    canonical: List[Any] = []
+    for part in parts:
+        if isinstance(part, dict) and "parts" in part:
+            # Multi-turn content: {"role": ..., "parts": [...]}
+            canonical.append({**part, "parts": _canonical_parts(part["parts"])})
+        elif isinstance(part, dict) and "data" in part:
+            data = part["data"]
+            if isinstance(data, str):
+                data = data.encode("ascii")
+            canonical.append(
+                {
+                    "mime_type": part.get("mime_type"),
+                    "sha256": hashlib.sha256(data).hexdigest(),
+                }
+            )
+        else:
+            canonical.append(part)
+    return canonical
+
+
+def config_digest(system_instruction: str, generation_config: Dict[str, Any]) -> str:
+    """SHA-256 of the request settings that live on the model, not in `parts`."""
+    payload = json.dumps(
+        {"system_instruction": system_instruction, "generation_config": generation_config},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def request_fingerprint(model_name: str, parts: ContentParts, config: str = "") -> str:
+    """
+    Stable SHA-256 over the model name, `config` (a `config_digest`) and the
+    canonicalised content parts.
+    """
+    payload = json.dumps(
+        {"model": model_name, "config": config, "parts": _canonical_parts(parts)},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ─── Gemini ───────────────────────────────────────────────────────────────────
+
+
+class GeminiBackend:
+    """
+    Live backend around a configured `genai.GenerativeModel`.
+
+    With a `prompt_cache`, calls go to the cache-bound model while the cache
+    is live and fall back to `model` (inline system instruction) otherwise —
+    including when the upstream reports the cache gone mid-flight.
+
+    The SDK is synchronous, so calls run on `executor` — a dedicated pool,
+    not the loop's default one (min(32, cpu + 4) threads), which would cap
+    upstream concurrency regardless of how many keys are configured.
+    """
+
+    def __init__(
+        self,
+        model: Any,
+        model_name: str,
+        prompt_cache: Optional[PromptCache] = None,
+        cache_stats: Optional[PromptCacheStats] = None,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self._model = model
+        self.model_name = model_name
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=DEFAULT_UPSTREAM_THREADS, thread_name_prefix="gemini"
+        )
+        self.prompt_cache = prompt_cache
+        self._cache_stats = cache_stats
+
+    async def generate(self, parts: ContentParts) -> BackendResponse:
+        # Gemini SDK is synchronous — run on the dedicated pool so the event
+        # loop is never blocked
+        loop = asyncio.get_running_loop()
+        cached_model = self.prompt_cache.model() if self.prompt_cache else None
+
+        t0 = time.perf_counter()
+        response = None
+        used_cache = cached_model is not None
+        if used_cache:
+            try:
+                response = await loop.run_in_executor(
+                    self._executor, lambda: cached_model.generate_content(parts)
+                )
+            except Exception as exc:
+                if not is_cache_miss_error(exc):
+                    raise
+                self.prompt_cache.invalidate()
+                used_cache = False
+                if self._cache_stats is not None:
+                    self._cache_stats.record_fallback()
+                t0 = time.perf_counter()
+        if response is None:
+            response = await loop.run_in_executor(
+                self._executor, lambda: self._model.generate_content(parts)
+            )
+
+        usage = _usage_dict(response)
+        if self._cache_stats is not None:
+            self._cache_stats.record(
+                cached=used_cache,
+                usage=usage,
+                latency_ms=(time.perf_counter() - t0) * 1000,
+            )
+        return BackendResponse(text=response.text, usage=usage)
+
+
+def _usage_dict(response: Any) -> Dict[str, int]:
+    meta = getattr(response, "usage_metadata", None)
+    if meta is None:
+        return {}
+    usage: Dict[str, int] = {}
+    for key in (
+        "prompt_token_count",
+        "candidates_token_count",
+        "total_token_count",
+        "cached_content_token_count",
+    ):
+        value = getattr(meta, key, None)
+        if value is not None:
+            usage[key] = int(value)
+    return usage
+
+
+# ─── Record / replay ──────────────────────────────────────────────────────────
+
+
+class RecordingBackend:
+    """
+    Pass-through backend that stores each exchange as a cassette.
+    Existing cassettes are overwritten so a re-record picks up prompt changes;
+    `config` is the `config_digest` of the system instruction and generation
+    config the inner backend sends.
+    """
+
+    def __init__(
+        self, inner: VisionBackend, cassette_dir: str | os.PathLike, config: str = ""
+    ) -> None:
+        self._inner = inner
+        self.model_name = inner.model_name
+        self.config = config
+        self.cassette_dir = Path(cassette_dir)
+        self.cassette_dir.mkdir(parents=True, exist_ok=True)
+
+    async def generate(self, parts: ContentParts) -> BackendResponse:
+        t0 = time.perf_counter()
+        response = await self._inner.generate(parts)
+        latency_ms = int((time.perf_counter() - t0) * 1000)
+
+        fingerprint = request_fingerprint(self.model_name, parts, self.config)
+        cassette = {
+            "fingerprint": fingerprint,
+            "model": self.model_name,
+            "config": self.config,
+            "parts": _canonical_parts(parts),
+            "text": response.text,
+            "usage": response.usage,
+            "latency_ms": latency_ms,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        }
+        path = self.cassette_dir / f"{fingerprint}.json"
+        tmp = path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(cassette, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+        logger.debug("Recorded cassette %s (%d ms)", fingerprint[:12], latency_ms)
+        return response
+
+
+class ReplayBackend:
+    """
+    Serves recorded cassettes without touching the network.
+
+    Args:
+        cassette_dir:  Directory written by RecordingBackend.
+        latency_ms:    None → sleep for each cassette's recorded latency;
+                       a number → sleep that long for every call (0 = full speed).
+        strict:        True  → unknown fingerprints raise CassetteMissError.
+                       False → fall back to cycling through all cassettes in
+                               fingerprint order (for load tests with fresh images).
+        config:        `config_digest` of the current prompt / generation config;
+                       cassettes recorded under another one never match.
+    """
+
+    def __init__(
+        self,
+        cassette_dir: str | os.PathLike,
+        model_name: str = "replay",
+        latency_ms: Optional[float] = None,
+        strict: bool = True,
+        config: str = "",
+    ) -> None:
+        self.cassette_dir = Path(cassette_dir)
+        self.model_name = model_name
+        self.latency_ms = latency_ms
+        self.strict = strict
+        self.config = config
+
+        self._cassettes: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(self.cassette_dir.glob("*.json")):
+            cassette = json.loads(path.read_text(encoding="utf-8"))
+            self._cassettes[cassette["fingerprint"]] = cassette
+        if not self._cassettes:
+            raise ValueError(f"No cassettes found in {self.cassette_dir}.")
+
+        # Cassettes remember which model recorded them; match on that name
+        recorded_models = {c.get("model") for c in self._cassettes.values()}
+        if model_name == "replay" and len(recorded_models) == 1:
+            self.model_name = recorded_models.pop()
+
+        self._fallback = itertools.cycle(sorted(self._cassettes))
+        logger.info(
+            "ReplayBackend loaded %d cassettes from %s", len(self._cassettes), self.cassette_dir
+        )
+
+    async def generate(self, parts: ContentParts) -> BackendResponse:
+        fingerprint = request_fingerprint(self.model_name, parts, self.config)
+        cassette = self._cassettes.get(fingerprint)
+        if cassette is None:
+            if self.strict:
+                raise CassetteMissError(f"No cassette for request {fingerprint[:12]}.")
+            cassette = self._cassettes[next(self._fallback)]
+
+        delay_ms = cassette.get("latency_ms", 0) if self.latency_ms is None else self.latency_ms
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+        return BackendResponse(text=cassette["text"], usage=dict(cassette.get("usage") or {}))
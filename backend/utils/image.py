@@ -3,10 +3,12 @@ Image processing utilities for the Cimas iGo Vision AI backend.
 
 Responsibilities:
   - Validate MIME type and file size of incoming uploads
-  - Convert raw bytes to PIL Image objects
+  - Convert raw bytes to PIL Image objects (HEIC / HEIF via pillow-heif, optional)
   - Normalise images (resize oversized images before sending to Gemini)
   - Convert PIL images to base64 for the Gemini multipart payload
   - Generate a lightweight thumbnail URI for the response (optional)
+  - Estimate the in-flight memory footprint of an upload from its header
+  - Cheap local quality gate (blur / exposure / subject size) before Gemini
 """
 
 from __future__ import annotations
@@ -14,22 +16,121 @@ from __future__ import annotations
 import base64
 import io
 import logging
-from typing import Tuple
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 
+import numpy as np
 from PIL import Image, UnidentifiedImageError
 
+try:
+    import pillow_heif
+except ImportError:  # optional — without it HEIC / HEIF uploads are rejected
+    pillow_heif = None
+
 logger = logging.getLogger(__name__)
 
 # ─── Constants ────────────────────────────────────────────────────────────────
 
-ALLOWED_MIME_TYPES: set[str] = {"image/jpeg", "image/png", "image/webp", "image/heic"}
+ALLOWED_MIME_TYPES: set[str] = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
 MAX_DIMENSION = 2048   # Gemini works well up to 2048 px; anything larger is trimmed
 JPEG_QUALITY = 88      # Re-encode quality when resizing
+QUALITY_ANALYSIS_SIDE = 512  # Quality metrics are computed on a ≤512 px greyscale copy
+
+# ISO-BMFF major brands of HEVC-coded HEIF stills / sequences (iPhone: "heic")
+_HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"hevm", b"hevs", b"mif1", b"msf1"}
+_UNSUPPORTED_FORMAT = "Could not identify image format. Upload a JPEG, PNG, WebP, or HEIC."
+
+
+@dataclass
+class DecodeReport:
+    """How an upload was decoded, for logs and benchmarks."""
+
+    source_format: str              # "JPEG", "PNG", "WEBP", "HEIF", ...
+    source_size: Tuple[int, int]    # After orientation, before resizing
+    decoded_size: Tuple[int, int]   # What the rest of the pipeline sees
+    decode_ms: float
+    resize_ms: float
+
+
+# ─── Quality gate types ───────────────────────────────────────────────────────
+
+
+@dataclass(frozen=True)
+class QualityThresholds:
+    """
+    Tunables for `assess_image_quality`. Blur / edge values are measured on the
+    ≤QUALITY_ANALYSIS_SIDE greyscale copy, so they are resolution-independent.
+    Defaults are provisional and not yet validated on labelled meal photos, so
+    `enforce` is off by default — run scripts/calibrate_image_quality.py on a
+    labelled sample set before enforcing them.
+    """
+
+    min_side_px: int = 224              # Reject: shorter side of the processed image
+    blur_reject_var: float = 15.0       # Reject: Laplacian variance below this
+    blur_warn_var: float = 60.0         # Warn:   Laplacian variance below this
+    dark_reject_mean: float = 28.0      # Reject: mean luminance (0–255) below this
+    bright_reject_mean: float = 235.0   # Reject: mean luminance above this
+    clipped_warn_fraction: float = 0.35 # Warn:   share of pixels crushed to ≤15 or ≥240
+    edge_threshold: float = 24.0        # |gx| + |gy| above this counts as "detail"
+    min_subject_fraction: float = 0.08  # Warn:   detail bounding box / frame area
+    enforce: bool = False               # False → every rejection becomes a warning
+
+
+@dataclass
+class QualityReport:
+    """Metrics and outcome of a single quality check."""
+
+    width: int
+    height: int
+    blur_variance: float
+    mean_luminance: float
+    clipped_fraction: float
+    subject_fraction: float
+    elapsed_ms: float
+    warnings: List[str] = field(default_factory=list)
+    rejection: Optional[str] = None
+
+
+class ImageQualityError(ValueError):
+    """Raised when an image fails the quality gate; `code` is the API error_code."""
+
+    def __init__(self, code: str, message: str, report: QualityReport) -> None:
+        super().__init__(message)
+        self.code = code
+        self.report = report
+
+
+_QUALITY_MESSAGES = {
+    "IMAGE_TOO_SMALL": "Image resolution is too low. Move closer or use a larger photo.",
+    "IMAGE_TOO_BLURRY": "Image looks blurry. Hold the camera steady and retake the photo.",
+    "IMAGE_TOO_DARK": "Image is too dark. Retake the photo in better lighting.",
+    "IMAGE_OVEREXPOSED": "Image is overexposed. Avoid direct light or flash and retake.",
+    "IMAGE_POORLY_EXPOSED": "Large parts of the image are too dark or too bright.",
+    "SUBJECT_TOO_SMALL": "The meal fills only a small part of the frame. Move closer.",
+}
 
 
 # ─── Public API ───────────────────────────────────────────────────────────────
 
 
+def is_heif(data: bytes) -> bool:
+    """True if `data` starts with an HEVC HEIF `ftyp` box (e.g. iPhone .heic)."""
+    return len(data) >= 12 and data[4:8] == b"ftyp" and data[8:12] in _HEIF_BRANDS
+
+
+def _open_heif(data: bytes):
+    """Parse HEIF headers (no pixel decode). Raises ValueError if unsupported."""
+    if pillow_heif is None:
+        raise ValueError(
+            "HEIC images are not supported by this server. Upload a JPEG, PNG, or WebP."
+        )
+    try:
+        return pillow_heif.open_heif(data, convert_hdr_to_8bit=True)
+    except Exception as exc:
+        raise ValueError(f"Image validation failed: {exc}") from exc
+
+
 def validate_image_bytes(data: bytes, max_size: int) -> None:
     """
     Raise ValueError if:
@@ -44,12 +145,16 @@ def validate_image_bytes(data: bytes, max_size: int) -> None:
         mb = max_size / 1_048_576
         raise ValueError(f"Image exceeds the maximum allowed size of {mb:.0f} MB.")
 
+    if is_heif(data):
+        _open_heif(data)  # Header / item structure check; pixels decode in load_image
+        return
+
     # Quick format sniff via PIL — raises UnidentifiedImageError for non-images
     try:
         with Image.open(io.BytesIO(data)) as img:
             img.verify()  # Detects corrupt files
     except UnidentifiedImageError:
-        raise ValueError("Could not identify image format. Upload a JPEG, PNG, or WebP.")
+        raise ValueError(_UNSUPPORTED_FORMAT)
     except Exception as exc:
         raise ValueError(f"Image validation failed: {exc}") from exc
 
@@ -57,11 +162,21 @@ def validate_image_bytes(data: bytes, max_size: int) -> None:
 def load_image(data: bytes) -> Image.Image:
     """
     Load raw bytes into a PIL Image, converting to RGB (strips alpha channel
-    and handles HEIC/EXIF orientation via ImageOps.exif_transpose).
+    and applies EXIF orientation via ImageOps.exif_transpose). HEIC / HEIF
+    goes through `decode_heif` at full resolution.
     """
+    if is_heif(data):
+        return decode_heif(data, max_dim=None)[0]
+    return _load_with_format(data)[0]
+
+
+def _load_with_format(data: bytes) -> Tuple[Image.Image, str]:
+    """`load_image` for Pillow-native formats, plus the container format name."""
     from PIL import ImageOps
 
     img = Image.open(io.BytesIO(data))
+    # Read before exif_transpose / convert, which return format-less copies
+    source_format = img.format or "unknown"
 
     # Apply EXIF orientation (e.g. iPhone portrait photos)
     img = ImageOps.exif_transpose(img) or img
@@ -70,7 +185,69 @@ def load_image(data: bytes) -> Image.Image:
     if img.mode not in ("RGB", "L"):
         img = img.convert("RGB")
 
-    return img
+    return img, source_format
+
+
+def decode_heif(
+    data: bytes, max_dim: Optional[int] = MAX_DIMENSION
+) -> Tuple[Image.Image, DecodeReport]:
+    """
+    Decode the primary HEIF image to an RGB frame, then downscale it to at
+    most `max_dim` (None = keep full size). libheif always decodes at full
+    resolution; pillow-heif exposes no reduced-size decode.
+
+    libheif applies the container's rotation / mirror transforms while
+    decoding (pillow-heif resets the EXIF orientation tag to match), so no
+    separate transpose pass or copy is needed. iPhone photos are 512 px HEVC
+    tile grids; libheif decodes tiles on `pillow_heif.options.DECODE_THREADS`
+    threads. The reduction to `max_dim` uses Pillow's `reducing_gap`, so
+    sources ≥4× the target (48 MP captures) take a cheap integer box reduce
+    before the LANCZOS pass.
+    """
+    heif_file = _open_heif(data)
+    t0 = time.perf_counter()
+    try:
+        img = heif_file[heif_file.primary_index].to_pillow()
+    except Exception as exc:
+        raise ValueError(f"Could not decode HEIC image: {exc}") from exc
+    decode_ms = (time.perf_counter() - t0) * 1000
+
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    source_size = img.size
+
+    t1 = time.perf_counter()
+    w, h = source_size
+    if max_dim is not None and max(w, h) > max_dim:
+        ratio = min(max_dim / w, max_dim / h)
+        img = img.resize((int(w * ratio), int(h * ratio)), Image.LANCZOS, reducing_gap=2.0)
+    resize_ms = (time.perf_counter() - t1) * 1000
+
+    report = DecodeReport("HEIF", source_size, img.size, round(decode_ms, 1), round(resize_ms, 1))
+    logger.debug(
+        "HEIF decoded %dx%d → %dx%d in %.1f ms (+%.1f ms resize)",
+        *source_size, *img.size, decode_ms, resize_ms,
+    )
+    return img, report
+
+
+def decode_image(
+    data: bytes, max_dim: int = MAX_DIMENSION
+) -> Tuple[Image.Image, DecodeReport]:
+    """`load_image` + `resize_if_needed` for any supported format, timed."""
+    if is_heif(data):
+        return decode_heif(data, max_dim)
+
+    t0 = time.perf_counter()
+    img, source_format = _load_with_format(data)
+    decode_ms = (time.perf_counter() - t0) * 1000
+    source_size = img.size
+    t1 = time.perf_counter()
+    img = resize_if_needed(img, max_dim)
+    resize_ms = (time.perf_counter() - t1) * 1000
+    return img, DecodeReport(
+        source_format, source_size, img.size, round(decode_ms, 1), round(resize_ms, 1)
+    )
 
 
 def resize_if_needed(img: Image.Image, max_dim: int = MAX_DIMENSION) -> Image.Image:
@@ -112,15 +289,165 @@ def image_to_base64(img: Image.Image, fmt: str = "JPEG") -> Tuple[str, str]:
     return encoded, mime
 
 
-def process_upload(data: bytes, max_size: int) -> Tuple[str, str, Tuple[int, int]]:
+def estimate_processing_bytes(data: bytes, max_dim: int = MAX_DIMENSION) -> int:
+    """
+    Estimate the peak bytes held while `process_upload` + `analyze` run for
+    this upload, reading only the image header (no pixel data is decoded).
+
+    Accounts for:
+      - the raw upload bytes
+      - the decoded RGB source frame (plus one copy for EXIF transpose / convert,
+        or libheif's decode buffer for HEIC)
+      - the resized RGB frame sent on to Gemini
+      - the re-encoded JPEG buffer and its base64 string (4/3 × JPEG)
+
+    Raises ValueError if the header cannot be parsed.
     """
-    Full pipeline: validate → load → resize → base64-encode.
+    if is_heif(data):
+        w, h = _open_heif(data).size
+    else:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                w, h = img.size
+        except UnidentifiedImageError:
+            raise ValueError(_UNSUPPORTED_FORMAT)
+        except Exception as exc:
+            raise ValueError(f"Image validation failed: {exc}") from exc
+
+    src_frame = w * h * 3
+    ratio = min(1.0, max_dim / max(w, h, 1))
+    out_frame = int(w * ratio) * int(h * ratio) * 3
+    # JPEG at q88 rarely exceeds ~1/4 of the raw RGB frame; be generous.
+    jpeg_bytes = out_frame // 4
+    b64_bytes = (jpeg_bytes * 4) // 3
+
+    return len(data) + 2 * src_frame + out_frame + jpeg_bytes + b64_bytes
+
+
+def assess_image_quality(
+    img: Image.Image, thresholds: QualityThresholds = QualityThresholds()
+) -> QualityReport:
+    """
+    Score blur, exposure and subject size of an (already resized) image with
+    vectorised NumPy on a small greyscale copy — a few ms per image.
+
+    Returns a QualityReport whose `rejection` is the first failing error code
+    (or None) and whose `warnings` lists soft failures. Does not raise; see
+    `check_image_quality` for the raising variant.
+    """
+    t0 = time.perf_counter()
+    w, h = img.size
+
+    # Box-reduce by an integer factor (cheap), then greyscale
+    factor = max(1, -(-max(w, h) // QUALITY_ANALYSIS_SIDE))
+    small = img.reduce(factor) if factor > 1 else img
+    grey = np.asarray(small.convert("L"), dtype=np.uint8)
+    g = grey.astype(np.float32)
+
+    # ── Blur: variance of the 4-neighbour Laplacian ─────────────────────────
+    if g.shape[0] >= 3 and g.shape[1] >= 3:
+        lap = (
+            g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:]
+            - 4.0 * g[1:-1, 1:-1]
+        )
+        blur_variance = float(lap.var())
+    else:
+        blur_variance = 0.0
+
+    # ── Exposure: luminance histogram ───────────────────────────────────────
+    hist = np.bincount(grey.ravel(), minlength=256)
+    n = max(1, grey.size)
+    mean_luminance = float(hist @ np.arange(256)) / n
+    clipped_fraction = float(hist[:16].sum() + hist[240:].sum()) / n
+
+    # ── Subject size: bounding box of high-gradient pixels ─────────────────
+    gx = np.abs(np.diff(g, axis=1))[:-1, :]
+    gy = np.abs(np.diff(g, axis=0))[:, :-1]
+    detail = (gx + gy) > thresholds.edge_threshold
+    rows = np.flatnonzero(detail.any(axis=1))
+    cols = np.flatnonzero(detail.any(axis=0))
+    if rows.size and cols.size:
+        box = (rows[-1] - rows[0] + 1) * (cols[-1] - cols[0] + 1)
+        subject_fraction = float(box) / max(1, detail.size)
+    else:
+        subject_fraction = 0.0
+
+    report = QualityReport(
+        width=w,
+        height=h,
+        blur_variance=round(blur_variance, 2),
+        mean_luminance=round(mean_luminance, 2),
+        clipped_fraction=round(clipped_fraction, 4),
+        subject_fraction=round(subject_fraction, 4),
+        elapsed_ms=0.0,
+    )
+
+    failures: List[str] = []
+    if min(w, h) < thresholds.min_side_px:
+        failures.append("IMAGE_TOO_SMALL")
+    if mean_luminance < thresholds.dark_reject_mean:
+        failures.append("IMAGE_TOO_DARK")
+    elif mean_luminance > thresholds.bright_reject_mean:
+        failures.append("IMAGE_OVEREXPOSED")
+    if blur_variance < thresholds.blur_reject_var:
+        failures.append("IMAGE_TOO_BLURRY")
+    elif blur_variance < thresholds.blur_warn_var:
+        report.warnings.append("IMAGE_TOO_BLURRY")
+    if clipped_fraction > thresholds.clipped_warn_fraction and not failures:
+        report.warnings.append("IMAGE_POORLY_EXPOSED")
+    if subject_fraction < thresholds.min_subject_fraction:
+        report.warnings.append("SUBJECT_TOO_SMALL")
+
+    if failures:
+        if thresholds.enforce:
+            report.rejection = failures[0]
+        else:
+            report.warnings = failures + [c for c in report.warnings if c not in failures]
+
+    report.elapsed_ms = round((time.perf_counter() - t0) * 1000, 2)
+    return report
+
+
+def check_image_quality(
+    img: Image.Image, thresholds: QualityThresholds = QualityThresholds()
+) -> QualityReport:
+    """
+    Run `assess_image_quality` and raise ImageQualityError on rejection.
+    Returns the report (with any warnings) otherwise.
+    """
+    report = assess_image_quality(img, thresholds)
+    logger.debug(
+        "Quality gate: blur=%.1f lum=%.1f clipped=%.3f subject=%.3f in %.2f ms",
+        report.blur_variance,
+        report.mean_luminance,
+        report.clipped_fraction,
+        report.subject_fraction,
+        report.elapsed_ms,
+    )
+    if report.rejection:
+        raise ImageQualityError(
+            report.rejection, _QUALITY_MESSAGES[report.rejection], report
+        )
+    return report
+
+
+def process_upload(
+    data: bytes,
+    max_size: int,
+    quality: Optional[QualityThresholds] = None,
+) -> Tuple[str, str, Tuple[int, int], Optional[QualityReport], DecodeReport]:
+    """
+    Full pipeline: validate → decode + resize → quality gate → base64-encode.
+
+    The quality gate runs only when `quality` thresholds are given; it raises
+    ImageQualityError (a ValueError) on rejection, before the JPEG re-encode.
+    HEIC / HEIF is decoded server-side and always re-encoded as JPEG.
 
     Returns:
-        (base64_string, mime_type, (width, height))
+        (base64_string, mime_type, (width, height), quality_report_or_None, decode_report)
     """
     validate_image_bytes(data, max_size)
-    img = load_image(data)
-    img = resize_if_needed(img)
+    img, decode = decode_image(data)
+    report = check_image_quality(img, quality) if quality is not None else None
     b64, mime = image_to_base64(img)
-    return b64, mime, img.size
+    return b64, mime, img.size, report, decode
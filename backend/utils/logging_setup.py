@@ -0,0 +1,254 @@
+"""
+structlog configuration for the Cimas iGo Vision AI backend.
+
+Two modes:
+  - console — colourised ConsoleRenderer printed synchronously (local dev)
+  - json    — production pipeline:
+                * high-volume INFO events sampled per event name
+                * rendered to bytes with orjson
+                * handed to a bounded queue drained by a background thread,
+                  so the request path never blocks on stdout
+
+Payload capture (raw model text etc.) is gated on DEBUG — callers check
+`logger.isEnabledFor(logging.DEBUG)` before building large strings.
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Any, BinaryIO, Dict, List, Optional
+
+import orjson
+import structlog
+
+# Third-party loggers that are chatty at INFO (one line per HTTP call / form
+# part / token refresh). Held at WARNING whatever LOG_LEVEL says.
+QUIET_LOGGERS = (
+    "httpx",
+    "httpcore",
+    "python_multipart",
+    "multipart",
+    "google.auth",
+    "google_auth_httplib2",
+    "urllib3",
+)
+
+# ─── Queue-backed writer ──────────────────────────────────────────────────────
+
+
+class QueueLogWriter:
+    """
+    File-like sink for structlog's BytesLogger. `write` enqueues and returns
+    immediately; a daemon thread batches lines out to `stream`. When the queue
+    is full, lines are dropped (and counted) rather than blocking a request.
+    """
+
+    _STOP = object()
+
+    def __init__(self, stream: Optional[BinaryIO] = None, maxsize: int = 10_000) -> None:
+        self._stream = stream if stream is not None else sys.stdout.buffer
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=maxsize)
+        self.written = 0
+        self.dropped = 0
+        self._thread = threading.Thread(
+            target=self._drain, name="log-writer", daemon=True
+        )
+        self._thread.start()
+
+    # ── File-like API used by structlog.BytesLogger ──────────────────────────
+
+    def write(self, data: bytes) -> None:
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        # Flushing happens on the writer thread
+        pass
+
+    # ── Lifecycle / metrics ──────────────────────────────────────────────────
+
+    def close(self, timeout: float = 2.0) -> None:
+        """Drain outstanding lines and stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    # ── Writer thread ────────────────────────────────────────────────────────
+
+    def _drain(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch: List[bytes] = []
+            stop = item is self._STOP
+            if not stop:
+                batch.append(item)
+            # Grab whatever else is already queued and write it in one syscall
+            while not stop:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                try:
+                    self._stream.write(b"".join(batch))
+                    self._stream.flush()
+                    self.written += len(batch)
+                except Exception:
+                    self.dropped += len(batch)
+            if stop:
+                return
+
+
+# ─── Processors ───────────────────────────────────────────────────────────────
+
+
+class EventSampler:
+    """
+    structlog processor that keeps only a fraction of selected INFO/DEBUG
+    events, e.g. {"request": 0.1}. Warnings, errors and `request` events with
+    a 4xx/5xx status are always kept.
+    """
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        self.rates = {k: min(1.0, max(0.0, v)) for k, v in rates.items()}
+        self._random = random.random
+
+    def __call__(self, logger: Any, method_name: str, event_dict: Dict[str, Any]):
+        rate = self.rates.get(event_dict.get("event"))
+        if rate is None or rate >= 1.0 or method_name not in ("info", "debug"):
+            return event_dict
+        if event_dict.get("status", 0) >= 400:
+            return event_dict
+        if self._random() >= rate:
+            raise structlog.DropEvent
+        event_dict["sample_rate"] = rate
+        return event_dict
+
+
+def parse_sample_rates(raw: str) -> Dict[str, float]:
+    """Parse "request=0.1,Image accepted=0.25" into a dict."""
+    rates: Dict[str, float] = {}
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        name, _, value = item.rpartition("=")
+        rates[name.strip()] = float(value)
+    return rates
+
+
+class _StdlibJsonHandler(logging.Handler):
+    """Routes stdlib `logging` records (services, utils) into the same writer."""
+
+    def __init__(self, writer: QueueLogWriter) -> None:
+        super().__init__()
+        self._writer = writer
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            payload = {
+                "timestamp": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)
+                ) + f".{int(record.msecs):03d}Z",
+                "level": record.levelname.lower(),
+                "logger": record.name,
+                "event": record.getMessage(),
+            }
+            if record.exc_info:
+                payload["exception"] = logging.Formatter().formatException(record.exc_info)
+            self._writer.write(orjson.dumps(payload) + b"\n")
+        except Exception:
+            self.handleError(record)
+
+
+# ─── Configuration ────────────────────────────────────────────────────────────
+
+
+def configure_logging(
+    fmt: str = "console",
+    level: str = "INFO",
+    sample_rates: Optional[Dict[str, float]] = None,
+    queue_size: int = 10_000,
+    stream: Optional[BinaryIO] = None,
+) -> Optional[QueueLogWriter]:
+    """
+    Configure structlog and stdlib logging (services / utils log via stdlib).
+
+    Returns the QueueLogWriter in json mode so the caller can close it on
+    shutdown and export its counters; None in console mode.
+    """
+    level_no = logging.getLevelName(level.upper())
+    if not isinstance(level_no, int):
+        level_no = logging.INFO
+
+    if fmt != "json":
+        structlog.configure(
+            processors=[
+                structlog.processors.TimeStamper(fmt="iso"),
+                structlog.stdlib.add_log_level,
+                structlog.stdlib.PositionalArgumentsFormatter(),
+                structlog.processors.StackInfoRenderer(),
+                structlog.processors.format_exc_info,
+                structlog.dev.ConsoleRenderer(),
+            ],
+            wrapper_class=structlog.make_filtering_bound_logger(level_no),
+            context_class=dict,
+            logger_factory=structlog.PrintLoggerFactory(),
+        )
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s [%(levelname)-8s] %(name)s: %(message)s")
+        )
+        _configure_stdlib(handler, level_no)
+        return None
+
+    writer = QueueLogWriter(stream=stream, maxsize=queue_size)
+    processors: List[Any] = []
+    if sample_rates:
+        # Sample first so dropped events skip timestamping and rendering
+        processors.append(EventSampler(sample_rates))
+    processors += [
+        structlog.processors.add_log_level,
+        structlog.processors.TimeStamper(fmt="iso", utc=True),
+        structlog.processors.format_exc_info,
+        structlog.processors.JSONRenderer(serializer=orjson.dumps),
+    ]
+    structlog.configure(
+        processors=processors,
+        wrapper_class=structlog.make_filtering_bound_logger(level_no),
+        context_class=dict,
+        logger_factory=structlog.BytesLoggerFactory(file=writer),
+        cache_logger_on_first_use=True,
+    )
+
+    _configure_stdlib(_StdlibJsonHandler(writer), level_no)
+    return writer
+
+
+def _configure_stdlib(handler: logging.Handler, level_no: int) -> None:
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level_no)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level_no, logging.WARNING))
@@ -0,0 +1,163 @@
+"""
+Process-wide memory budget for in-flight image processing.
+
+Each /analyze request holds the raw upload, one or more decoded RGB frames,
+the re-encoded JPEG and its base64 string at the same time. Request
+concurrency alone says little about memory — ten 500 KB thumbnails are cheap,
+ten 12 MP photos are not — so admission is denominated in bytes instead.
+
+Usage:
+    budget = ImageMemoryBudget(capacity_bytes=256 * 1024 * 1024, wait_timeout_s=5)
+
+    async with budget.reserve(estimate_processing_bytes(data)) as reservation:
+        ...  # decode, resize, encode
+        await reservation.shrink(len(raw) + len(b64))
+        ...  # call Gemini — only the upload and its base64 stay alive
+
+Requests wait (via asyncio.Condition) until enough of the budget is
+free, up to `wait_timeout_s`, then fail with MemoryBudgetExceeded.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+logger = logging.getLogger(__name__)
+
+
+# ─── Errors ───────────────────────────────────────────────────────────────────
+
+
+class MemoryBudgetExceeded(Exception):
+    """
+    Raised when a reservation cannot be admitted.
+
+    `too_large` is True when the request alone exceeds the whole budget
+    (it will never fit, so retrying is pointless), False when the budget was
+    merely exhausted for longer than the wait deadline.
+    """
+
+    def __init__(self, message: str, requested: int, too_large: bool = False) -> None:
+        super().__init__(message)
+        self.requested = requested
+        self.too_large = too_large
+
+
+# ─── Budget ───────────────────────────────────────────────────────────────────
+
+
+class Reservation:
+    """Handle yielded by `ImageMemoryBudget.reserve`; can only shrink."""
+
+    def __init__(self, budget: "ImageMemoryBudget", nbytes: int) -> None:
+        self._budget = budget
+        self.nbytes = nbytes
+
+    async def shrink(self, nbytes: int) -> None:
+        """Return everything above `nbytes` to the budget (e.g. after decode)."""
+        nbytes = max(0, int(nbytes))
+        if nbytes < self.nbytes:
+            await self._budget._release(self.nbytes - nbytes)
+            self.nbytes = nbytes
+
+
+class ImageMemoryBudget:
+    """
+    Byte-denominated admission semaphore shared by all requests in the process.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, capacity_bytes: int, wait_timeout_s: float = 5.0) -> None:
+        if capacity_bytes <= 0:
+            raise ValueError("capacity_bytes must be positive.")
+        self.capacity_bytes = capacity_bytes
+        self.wait_timeout_s = max(0.0, wait_timeout_s)
+
+        self._cond = asyncio.Condition()
+        self._reserved = 0
+        self._peak_reserved = 0
+        self._waiting = 0
+        self._admitted_total = 0
+        self._rejected_total = 0
+        self._timed_out_total = 0
+
+    # ── Public API ────────────────────────────────────────────────────────────
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int) -> AsyncIterator[Reservation]:
+        """
+        Reserve `nbytes` of the budget for the duration of the `async with`
+        block. Raises MemoryBudgetExceeded if it cannot be admitted in time.
+        The yielded Reservation can give back bytes early via `shrink`.
+        """
+        nbytes = max(0, int(nbytes))
+        await self._acquire(nbytes)
+        reservation = Reservation(self, nbytes)
+        try:
+            yield reservation
+        finally:
+            await self._release(reservation.nbytes)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current counters, suitable for the /metrics endpoint."""
+        return {
+            "capacity_bytes": self.capacity_bytes,
+            "reserved_bytes": self._reserved,
+            "peak_reserved_bytes": self._peak_reserved,
+            "waiting_requests": self._waiting,
+            "admitted_total": self._admitted_total,
+            "rejected_total": self._rejected_total,
+            "timed_out_total": self._timed_out_total,
+        }
+
+    # ── Private helpers ───────────────────────────────────────────────────────
+
+    def _fits(self, nbytes: int) -> bool:
+        return self._reserved + nbytes <= self.capacity_bytes
+
+    async def _acquire(self, nbytes: int) -> None:
+        if nbytes > self.capacity_bytes:
+            self._rejected_total += 1
+            raise MemoryBudgetExceeded(
+                f"Image needs ~{nbytes // 1_048_576} MB to process, "
+                f"above the {self.capacity_bytes // 1_048_576} MB budget.",
+                requested=nbytes,
+                too_large=True,
+            )
+
+        async with self._cond:
+            if not self._fits(nbytes):
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(lambda: self._fits(nbytes)),
+                        timeout=self.wait_timeout_s,
+                    )
+                except asyncio.TimeoutError:
+                    self._rejected_total += 1
+                    self._timed_out_total += 1
+                    logger.warning(
+                        "Image memory budget exhausted: %d bytes requested, %d/%d reserved",
+                        nbytes,
+                        self._reserved,
+                        self.capacity_bytes,
+                    )
+                    raise MemoryBudgetExceeded(
+                        "Server is busy processing other images.",
+                        requested=nbytes,
+                    )
+                finally:
+                    self._waiting -= 1
+
+            self._reserved += nbytes
+            self._admitted_total += 1
+            if self._reserved > self._peak_reserved:
+                self._peak_reserved = self._reserved
+
+    async def _release(self, nbytes: int) -> None:
+        async with self._cond:
+            self._reserved -= nbytes
+            self._cond.notify_all()